@@ -0,0 +1,279 @@
+"""
+Local HTTP service running the analyses in a pool of warm worker processes, so each request pays
+for the analysis only and not for starting Python and importing OpenCV, PIL and NumPy.
+
+    python AnalysisService.py --port 8765 --workers 4
+
+Endpoints (POST) return JSON records in the ResultsStore format:
+
+    /relative-red    {"path": ..., "threshold": 30, "roi_path": ... or "areas": [[x1, y1, x2, y2], ...], "union": false}
+    /lipid-nuclei    {"path": ..., "profile": "<profile.json or _points.csv>", "save_overlay": false}
+    /standardize     {"path": ..., "format": "png", "png_compression": null}  -> {"output": <standardized path>}
+
+Instead of a JSON body, the request body can be the image file itself, with the parameters in the
+query string (e.g. POST /relative-red?threshold=30&areas=[[0,0,100,100]]). Posted images are decoded
+once here and handed to the workers through shared memory rather than pickled; /standardize then
+responds with the encoded standardized image. GET /health reports the number of workers.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context, shared_memory
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+import ImageStandardizer
+import RelativeRed
+import UpdatedCodeLipidNuclei
+
+HOST = '127.0.0.1'   # only local clients
+PORT = 8765
+
+
+# ===== worker side =====
+
+# runs once in each worker process, so the first request does not pay for lazy setup either
+def warm_up():
+    UpdatedCodeLipidNuclei.class_table()
+    ImageStandardizer.get_clahe()
+    return os.getpid()
+
+
+# attaches to a shared memory block created by the service, which stays responsible for unlinking it
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        # workers share the service's resource tracker, so registering the block again is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def shared_array(spec):
+    shm = attach(spec['name'])
+    return shm, np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=shm.buf)
+
+
+def red_from_shared(spec, name, coords, threshold, union):
+    shm, image = shared_array(spec)
+    try:
+        whole, selected = RelativeRed.red_percentages(image[..., ::-1], coords, threshold, union)  # BGR to RGB view
+    finally:
+        del image
+        shm.close()
+    params = {'red_threshold': threshold, 'areas': coords, 'union': union}
+    return RelativeRed.relative_red_record(name, whole, selected, params)
+
+
+def red_from_path(path, coords, threshold, union):
+    whole, selected = RelativeRed.red_percentages(RelativeRed.load_rgb(path), coords, threshold, union)
+    params = {'red_threshold': threshold, 'areas': coords, 'union': union}
+    return RelativeRed.relative_red_record(path, whole, selected, params)
+
+
+def lipid_from_shared(spec, name, profile):
+    shm, image = shared_array(spec)
+    try:
+        results, total_pixels = UpdatedCodeLipidNuclei.analyze_array(image, profile)
+    finally:
+        del image
+        shm.close()
+    return UpdatedCodeLipidNuclei.results_record(name, results, total_pixels, profile)
+
+
+def standardize_shared(spec, out_spec):
+    shm, image = shared_array(spec)
+    out_shm, out = shared_array(out_spec)
+    try:
+        out[:] = ImageStandardizer.white_balance(image)
+    finally:
+        del image, out
+        shm.close()
+        out_shm.close()
+
+
+# ===== service side =====
+
+class SharedImage:
+    """A copy of an array in a new shared memory block, unlinked when the with block ends."""
+    def __init__(self, array):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)
+        self.array[:] = array
+        self.spec = {'name': self.shm.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+        return False
+
+
+class RequestError(Exception):
+    """A request the service cannot run, answered with 400 Bad Request."""
+
+
+def decode_body(body):
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise RequestError('the request body is neither JSON nor a readable image')
+    return image
+
+
+# query string values come as strings; JSON-looking values (numbers, lists, booleans) are parsed
+def query_params(query):
+    params = {}
+    for key, values in parse_qs(query).items():
+        try:
+            params[key] = json.loads(values[-1])
+        except ValueError:
+            params[key] = values[-1]
+    return params
+
+
+def run_relative_red(executor, params, body):
+    threshold = int(params.get('threshold', 30))
+    union = bool(params.get('union', False))
+    if body is None:
+        path = params['path']
+        if 'areas' in params:
+            return executor.submit(red_from_path, path, params['areas'], threshold, union).result()
+        if not params.get('roi_path'):
+            raise RequestError('give the selected areas as "areas" or "roi_path", the service cannot open a selection window')
+        return executor.submit(RelativeRed.get_relative_red, path, threshold, params['roi_path'], union,
+                               bool(params.get('standardize', False))).result()
+    with SharedImage(decode_body(body)) as image:
+        return executor.submit(red_from_shared, image.spec, params.get('name', 'upload'), params.get('areas', []),
+                               threshold, union).result()
+
+
+def run_lipid_nuclei(executor, params, body):
+    if 'profile' not in params:
+        raise RequestError('a calibration "profile" path is required')
+    if body is None:
+        return executor.submit(UpdatedCodeLipidNuclei.analyze_with_profile, params['path'], params['profile'],
+                               bool(params.get('save_overlay', False)), bool(params.get('standardize', False))).result()
+    profile = UpdatedCodeLipidNuclei.load_profile(params['profile'])
+    with SharedImage(decode_body(body)) as image:
+        return executor.submit(lipid_from_shared, image.spec, params.get('name', 'upload'), profile).result()
+
+
+def run_standardize(executor, params, body):
+    output_format = params.get('format', ImageStandardizer.OUTPUT_FORMAT)
+    png_compression = params.get('png_compression', ImageStandardizer.PNG_COMPRESSION)
+    if body is None:
+        output = executor.submit(ImageStandardizer.standardize_image, params['path'], output_format,
+                                 png_compression).result()
+        return {'output': output}
+    image = decode_body(body)
+    with SharedImage(image) as shared_in, SharedImage(np.empty_like(image)) as shared_out:
+        executor.submit(standardize_shared, shared_in.spec, shared_out.spec).result()
+        ok, encoded = cv2.imencode(f'.{output_format}', shared_out.array,
+                                   ImageStandardizer.encode_params(output_format, png_compression))
+    if not ok:
+        raise RequestError(f'could not encode the result as {output_format}')
+    return encoded.tobytes()
+
+
+ENDPOINTS = {
+    '/relative-red': run_relative_red,
+    '/lipid-nuclei': run_lipid_nuclei,
+    '/standardize': run_standardize,
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, {'status': 'ok', 'workers': self.server.workers})
+        else:
+            self.send_json(404, {'error': f'unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ENDPOINTS:
+            self.send_json(404, {'error': f'unknown endpoint {url.path}'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = query_params(url.query)
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body or b'{}'))
+                body = None
+            elif not body:
+                raise RequestError('send a JSON body with a "path", or the image itself')
+            if body is None and 'path' not in params:
+                raise RequestError('a "path" is required')
+            result = ENDPOINTS[url.path](self.server.executor, params, body)
+        except (RequestError, KeyError, ValueError) as e:
+            self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+
+        if isinstance(result, bytes):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(result)))
+            self.end_headers()
+            self.wfile.write(result)
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, value):
+        data = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the output of the analyses
+
+
+# starts the worker pool and imports/warms every worker before the first request arrives
+def start_workers(workers):
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=warm_up)
+    # workers are started on demand, one task per worker starts them all now
+    for future in [executor.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+    return executor
+
+
+def serve(host=HOST, port=PORT, workers=None):
+    workers = workers or os.cpu_count() or 1
+    executor = start_workers(workers)
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.executor, server.workers = executor, workers
+    print(f'Analysis service listening on http://{host}:{server.server_address[1]} with {workers} workers.')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        executor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the analyses over HTTP with warm worker processes.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=0, help='worker processes, 0 for one per CPU core')
+    args = parser.parse_args(argv)
+    try:
+        serve(args.host, args.port, args.workers)
+    except KeyboardInterrupt:
+        print('Stopped.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Benchmarks every pipeline stage on synthetic stained images and reports megapixels per second
+and peak RSS (the whole process, and the part the stage itself adds). Results are saved as JSON and can be compared against a stored baseline:
+
+    python Benchmark.py --sizes 1 4 20 --output bench.json
+    python Benchmark.py --baseline bench.json --tolerance 0.15
+    python Benchmark.py --stages --startup red lipid      (start-up times only)
+
+Start-up time is measured for every main.py command: a fresh interpreter running the command on a
+missing image, which covers starting Python and importing what the command needs, but no analysis.
+
+Runs headless: areas come from a saved sidecar and no OpenCV windows are opened. Each
+stage/size runs in a fresh process so its peak RSS is not inflated by earlier cases, and the peak is
+measured from after the synthetic image is made (on Linux), so it shows the stage, not the set-up.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+
+# time the analyses themselves, never cached results
+os.environ['LND_CACHE'] = 'off'
+
+DEFAULT_SIZES = [1, 4, 20, 100]   # megapixels
+DEFAULT_REPEAT = 3                # timed runs per case, the fastest is reported
+DEFAULT_TOLERANCE = 0.10          # allowed throughput drop against the baseline
+BATCH_IMAGES = 8                  # images per folder for the run_script batch stage
+RED_THRESHOLD = 30
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+# main.py command lines timed for start-up, each given a missing image so no analysis runs
+STARTUP_COMMANDS = {
+    'standardize': ['standardize', 'missing.png'],
+    'red': ['red', 'missing.png', '--threshold', str(RED_THRESHOLD)],
+    'sweep': ['sweep', 'missing.png'],
+    'lipid': ['lipid', 'missing.png', '--profile', 'missing_profile.json'],
+    'stack': ['stack', 'missing.tif', '--standardize'],
+    'screen': ['screen', 'missing.png', '--red', str(RED_THRESHOLD), '--cutoff', '5'],
+    'clear-cache': ['clear-cache'],
+}
+
+
+# makes a synthetic stained slide: pale background, red lipid droplets and blue nuclei, as BGR.
+def synthetic_image(megapixels, seed=0):
+    rng = np.random.default_rng(seed)
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+
+    # low resolution noise fields scaled up give blob shaped objects at any image size
+    def blobs(threshold):
+        field = rng.random((max(2, height // 16), max(2, width // 16)), dtype=np.float32)
+        field = cv2.resize(cv2.GaussianBlur(field, (0, 0), 1.5), (width, height), interpolation=cv2.INTER_LINEAR)
+        return field > threshold
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (215, 205, 225)                  # pale pink background (BGR)
+    image[blobs(0.56)] = (70, 60, 200)          # lipids: red dominant
+    image[blobs(0.57)] = (190, 80, 60)          # nuclei: blue dominant
+    image += rng.integers(0, 20, image.shape, dtype=np.uint8)
+    return image
+
+
+def write_image_with_areas(image, folder, name):
+    """Write image as PNG with a saved areas sidecar covering its centre, returns the path."""
+    import SelectArea
+
+    path = os.path.join(folder, name)
+    cv2.imwrite(path, image)
+    h, w = image.shape[:2]
+    with contextlib.redirect_stdout(io.StringIO()):
+        SelectArea.save_areas(path, [[w // 4, h // 4, 3 * w // 4, 3 * h // 4], [0, 0, w // 3, h // 3]], folder)
+    return path
+
+
+# Each stage takes the synthetic BGR image and a scratch folder, does any untimed setup,
+# and returns (callable to time, megapixels processed per call).
+def stage_white_balance(image, folder):
+    import ImageStandardizer
+    return partial(ImageStandardizer.white_balance, image), image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_redscale(image, folder):
+    import RelativeRed
+    rgb = np.ascontiguousarray(image[..., ::-1])
+    return partial(RelativeRed.redscale_array, rgb), image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_percentage_red(image, folder):
+    import ImageLoader
+    import RelativeRed
+    path = write_image_with_areas(image, folder, 'slide.png')
+
+    def run():
+        ImageLoader.cache.clear()  # include the decode, as a fresh run would
+        return RelativeRed.percentage_red_pixels(path, RED_THRESHOLD, folder)
+    return run, image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_lipid_masks(image, folder):
+    import UpdatedCodeLipidNuclei
+    return partial(UpdatedCodeLipidNuclei.classify_channels, image), image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_lipid_morphology(image, folder):
+    import UpdatedCodeLipidNuclei
+    _, nuclei_mask = UpdatedCodeLipidNuclei.classify_channels(image)
+    return partial(UpdatedCodeLipidNuclei.clean_nuclei_mask, nuclei_mask), image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_lipid_overlay(image, folder):
+    import UpdatedCodeLipidNuclei
+    labels = UpdatedCodeLipidNuclei.label_map(UpdatedCodeLipidNuclei.build_masks(image))
+    return partial(UpdatedCodeLipidNuclei.render_overlay, image, labels), image.shape[0] * image.shape[1] / 1e6
+
+
+def stage_batch(image, folder):
+    import main
+    import RelativeRed
+    for i in range(BATCH_IMAGES):
+        write_image_with_areas(image, folder, f'slide_{i}.png')
+    function = partial(RelativeRed.get_relative_red, roi_path=folder)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return main.run_script(folder, function, RED_THRESHOLD, os.cpu_count())
+    return run, BATCH_IMAGES * image.shape[0] * image.shape[1] / 1e6
+
+
+STAGES = {
+    'white_balance': stage_white_balance,
+    'redscale': stage_redscale,
+    'percentage_red_pixels': stage_percentage_red,
+    'lipid_masks': stage_lipid_masks,
+    'lipid_morphology': stage_lipid_morphology,
+    'lipid_overlay': stage_lipid_overlay,
+    'run_script_batch': stage_batch,
+}
+
+
+# runs one stage at one size, meant to be called in a fresh process. The memory high-water mark is
+# reset once the image and the stage's inputs are ready, so peak_rss_mb covers the timed calls (with
+# the inputs they hold) and stage_rss_mb how far they took memory above what the set-up left. Where
+# the mark cannot be reset, peak_rss_mb is the process peak including the set-up and stage_rss_mb is None.
+def run_case(stage, megapixels, repeat):
+    import Profiling
+    image = synthetic_image(megapixels)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # stages that write output files write them here
+        func, processed_mp = STAGES[stage](image, folder)
+        reset = Profiling.reset_peak_rss()
+        setup_rss = Profiling.current_rss_mb()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        peak = Profiling.peak_since_reset_mb() if reset else Profiling.peak_rss_mb()
+        os.chdir(cwd)
+
+    seconds = min(times)
+    return {
+        'stage': stage,
+        'megapixels': megapixels,
+        'seconds': seconds,
+        'megapixels_per_second': processed_mp / seconds if seconds > 0 else float('inf'),
+        'peak_rss_mb': peak,
+        'stage_rss_mb': peak - setup_rss if reset and setup_rss is not None else None,
+    }
+
+
+def run_benchmarks(stages, sizes, repeat=DEFAULT_REPEAT):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for megapixels in sizes:
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_case, stage, megapixels, repeat).result()
+            print(f"{stage:>22} {megapixels:>6g} MP: {result['megapixels_per_second']:9.2f} MP/s, "
+                  f"{result['seconds']:.3f} s, peak RSS {result['peak_rss_mb'] or 0:.0f} MB"
+                  + (f" (+{result['stage_rss_mb']:.0f} MB over the set-up)" if result['stage_rss_mb'] is not None else ''))
+            results.append(result)
+    return results
+
+
+# seconds from starting a fresh interpreter on main.py <command> until it exits, the fastest of repeat runs
+def measure_startup(command, repeat=DEFAULT_REPEAT):
+    times = []
+    with tempfile.TemporaryDirectory() as folder:
+        # databases the command opens are created in the scratch folder, not next to real results
+        env = {**os.environ, 'LND_CACHE': os.path.join(folder, 'cache.sqlite'),
+               'LND_RESULTS': os.path.join(folder, 'results.sqlite')}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, MAIN_PATH, *STARTUP_COMMANDS[command]], cwd=folder, env=env,
+                           stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_startup(commands, repeat=DEFAULT_REPEAT):
+    results = []
+    for command in commands:
+        seconds = measure_startup(command, repeat)
+        print(f'{command:>22} start-up: {seconds * 1000:7.0f} ms')
+        results.append({'command': command, 'seconds': seconds})
+    return results
+
+
+"""
+Compares results against a baseline file, returning a message for every stage/size whose
+throughput dropped by more than tolerance (a fraction, 0.1 = 10%), and for every command in startup
+that takes longer to start by more than tolerance.
+"""
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE, startup=()):
+    expected = {(r['stage'], r['megapixels']): r['megapixels_per_second'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['stage'], result['megapixels'])
+        if key not in expected:
+            continue
+        change = result['megapixels_per_second'] / expected[key] - 1
+        if change < -tolerance:
+            regressions.append(f"{key[0]} at {key[1]:g} MP: {result['megapixels_per_second']:.2f} MP/s, "
+                               f"{-change:.1%} slower than the baseline {expected[key]:.2f} MP/s")
+
+    expected = {r['command']: r['seconds'] for r in baseline.get('startup', [])}
+    for result in startup:
+        if result['command'] in expected and result['seconds'] > expected[result['command']] * (1 + tolerance):
+            regressions.append(f"{result['command']} start-up: {result['seconds'] * 1000:.0f} ms, slower than "
+                               f"the baseline {expected[result['command']] * 1000:.0f} ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the image pipeline stages.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='image sizes in megapixels')
+    parser.add_argument('--stages', nargs='*', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--startup', nargs='*', choices=list(STARTUP_COMMANDS), default=list(STARTUP_COMMANDS),
+                        help='main.py commands whose start-up time is measured')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed runs per case (fastest is kept)')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to save the results JSON')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed throughput drop against the baseline, as a fraction')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.stages, args.sizes, args.repeat)
+    startup = run_startup(args.startup, args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+        'startup': startup,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved as {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance, startup)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            return 1
+        print(f'No stage is more than {args.tolerance:.0%} slower than {args.baseline}.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
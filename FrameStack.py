@@ -0,0 +1,186 @@
+"""
+Frame-by-frame analysis of multi-page TIFFs (z-stacks and time series).
+
+Every frame is decoded only when it is analysed, so memory does not grow with the stack length.
+Stacks are split into runs of FRAMES_PER_TASK frames that are analysed in parallel worker
+processes, so a folder of stacks (or a single long stack) uses every worker. Results are reported
+per frame as '<stack>[<page>]' and for the stack's max projection as '<stack>[max]':
+
+ - relative red: the red percentage of each frame, and of the per-pixel maximum red value over all frames
+ - lipids/nuclei: the class areas of each frame, and of the pixels that are lipid/nuclei in any frame
+ - standardize: each frame is written as StandardizedImages/<stack>_frame<page>_standardized.png (or to
+   settings['output_dir'])
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+import ImageLoader
+import ImageStandardizer
+import Profiling
+import RelativeRed
+import UpdatedCodeLipidNuclei
+
+# frames analysed per worker task
+FRAMES_PER_TASK = 8
+
+
+def frame_name(image_path, page):
+    return f'{image_path}[{page}]'
+
+
+def projection_name(image_path):
+    return f'{image_path}[max]'
+
+
+"""
+Analyses frames (page indices) of one stack. settings holds the analysis settings: 'threshold', 'areas'
+and 'union' for relative_red, 'profile' for lipid_nuclei, optionally 'output_dir' for standardize.
+Returns (per-frame records, projection), where projection is the max projection of these frames
+(red channel or label map), or None for standardize.
+"""
+def analyze_frames(image_path, frames, analysis, settings):
+    records = []
+    projection = None
+    # red is measured on RGB frames, the OpenCV-based analyses take BGR frames as cv2.imread gives them
+    channel_order = 'RGB' if analysis == 'relative_red' else 'BGR'
+    for page, frame in ImageLoader.iter_frames(image_path, frames, channel_order):
+        if analysis == 'relative_red':
+            with Profiling.stage('redscale'):
+                plane = RelativeRed.redscale_array(frame)
+            whole, selected = RelativeRed.red_channel_percentages(plane, settings['areas'], settings['threshold'],
+                                                                  settings['union'])
+            records.append(RelativeRed.relative_red_record(frame_name(image_path, page), whole, selected, settings))
+        elif analysis == 'lipid_nuclei':
+            profile = settings['profile']
+            masks = UpdatedCodeLipidNuclei.build_masks(frame, **UpdatedCodeLipidNuclei.mask_settings(profile))
+            plane = UpdatedCodeLipidNuclei.label_map(masks)
+            total_pixels = plane.shape[0] * plane.shape[1]
+            results = UpdatedCodeLipidNuclei.compute_results(UpdatedCodeLipidNuclei.label_counts(plane), total_pixels)
+            records.append(UpdatedCodeLipidNuclei.results_record(frame_name(image_path, page), results, total_pixels,
+                                                                 profile))
+        else:
+            name = os.path.splitext(os.path.basename(image_path))[0]
+            output_dir = settings.get('output_dir', ImageStandardizer.OUTPUT_DIR)
+            os.makedirs(output_dir, exist_ok=True)  # Creates the directory if it doesn't exist
+            balanced = ImageStandardizer.white_balance(frame)
+            with Profiling.stage('encode'):
+                cv2.imwrite(f'{output_dir}/{name}_frame{page:04d}_standardized.png', balanced)
+            continue
+
+        # red projections keep the brightest value, label projections every class seen in any frame
+        if projection is None:
+            projection = plane
+        elif analysis == 'relative_red':
+            np.maximum(projection, plane, out=projection)
+        else:
+            np.bitwise_or(projection, plane, out=projection)
+    return records, projection
+
+
+# record of a stack's max projection, from the projection merged over all its frames
+def projection_record(image_path, analysis, settings, projection):
+    if analysis == 'relative_red':
+        whole, selected = RelativeRed.red_channel_percentages(projection, settings['areas'], settings['threshold'],
+                                                              settings['union'])
+        return RelativeRed.relative_red_record(projection_name(image_path), whole, selected, settings)
+    total_pixels = projection.shape[0] * projection.shape[1]
+    results = UpdatedCodeLipidNuclei.compute_results(UpdatedCodeLipidNuclei.label_counts(projection), total_pixels)
+    return UpdatedCodeLipidNuclei.results_record(projection_name(image_path), results, total_pixels, settings['profile'])
+
+
+def merge_projection(analysis, projection, part):
+    if projection is None or part is None:
+        return part if projection is None else projection
+    if analysis == 'relative_red':
+        return np.maximum(projection, part, out=projection)
+    return np.bitwise_or(projection, part, out=projection)
+
+
+def describe_stack(image_path, frame_count, frame_records, stack_record):
+    name = os.path.basename(image_path)
+    if stack_record is None:
+        return f'\nThe stack {name}: {frame_count} frames standardized.\n'
+    if stack_record['analysis'] == 'relative_red':
+        whole = [record['rows'][0]['red_percent'] for record in frame_records]
+        return (f'\nThe stack {name} ({frame_count} frames) is {min(whole):.3f}-{max(whole):.3f}% red per frame, '
+                f"{stack_record['rows'][0]['red_percent']:.3f}% red in the max projection.\n")
+    lines = [f'\nThe stack {name} ({frame_count} frames), max projection:']
+    for row in stack_record['rows'][:-1]:
+        lines.append(f"{row['class']}: {row['pixel_count']} px, {row['area_um2']:.2f} µm², {row['percent']:.2f}%")
+    return '\n'.join(lines) + '\n'
+
+
+"""
+Analyses every frame of every stack in image_paths (see analyze_frames for settings). Frames from all
+stacks are spread over the worker processes FRAMES_PER_TASK at a time; each stack's projection is merged
+as its parts arrive and released once the stack is done. Per-frame and projection records go to store
+if given. Returns {image_path: (per-frame records in page order, projection record or None)}.
+"""
+def run_stacks(image_paths, analysis, settings_for, workers=1, store=None, frames_per_task=FRAMES_PER_TASK):
+    workers = workers or os.cpu_count() or 1
+    tasks = []
+    frame_counts = {}
+    for image_path in image_paths:
+        try:
+            frames = ImageLoader.stack_frames(image_path)
+        except Exception as e:
+            print(f'Error: {image_path} could not be processed ({type(e).__name__}: {e})')
+            continue
+        frame_counts[image_path] = len(frames)
+        for start in range(0, len(frames), frames_per_task):
+            tasks.append((image_path, frames[start:start + frames_per_task]))
+
+    settings = {image_path: settings_for(image_path) for image_path in dict.fromkeys(path for path, _ in tasks)}
+    remaining = {image_path: 0 for image_path in settings}
+    for image_path, _ in tasks:
+        remaining[image_path] += 1
+    frame_records = {image_path: [] for image_path in settings}
+    projections = {}
+    outputs = {}
+
+    def record(image_path, frames, records, part, error):
+        if error:
+            print(error)
+        frame_records[image_path].append((frames[0], records))
+        projections[image_path] = merge_projection(analysis, projections.get(image_path), part)
+        remaining[image_path] -= 1
+        if remaining[image_path] > 0:
+            return
+
+        # the last part of this stack arrived
+        records = [r for _, part_records in sorted(frame_records.pop(image_path), key=lambda p: p[0]) for r in part_records]
+        projection = projections.pop(image_path)
+        stack_record = None
+        if projection is not None:
+            stack_record = projection_record(image_path, analysis, settings[image_path], projection)
+        if store is not None:
+            for frame_record in records + ([stack_record] if stack_record else []):
+                store.add(frame_record)
+        print(describe_stack(image_path, frame_counts[image_path], records, stack_record))
+        outputs[image_path] = (records, stack_record)
+
+    if workers == 1:
+        for image_path, frames in tasks:
+            try:
+                records, part = analyze_frames(image_path, frames, analysis, settings[image_path])
+                record(image_path, frames, records, part, None)
+            except Exception as e:
+                record(image_path, frames, [], None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})')
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(analyze_frames, image_path, frames, analysis, settings[image_path]):
+                       (image_path, frames) for image_path, frames in tasks}
+            for future in as_completed(futures):
+                image_path, frames = futures[future]
+                try:
+                    records, part = future.result()
+                    record(image_path, frames, records, part, None)
+                except Exception as e:
+                    record(image_path, frames, [], None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})')
+    if store is not None:
+        store.flush()
+    return outputs
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+import Profiling
+
+# Decoded images kept in memory for reuse, in bytes. Least recently used images are dropped first.
+# Batch runs release an image's entries once its task is done (see release), so this only bounds
+# what one image and the analyses chained on it hold at a time.
+CACHE_MAX_BYTES = 1024 ** 3
+
+# Uncompressed arrays opened as memory maps instead of being decoded: .npy files, and raw files
+# described by a <file>.json sidecar such as {"shape": [h, w, 3], "dtype": "uint8", "channel_order": "BGR", "offset": 0}
+ARRAY_EXTENSIONS = {'.npy', '.raw'}
+
+
+"""
+Size-bounded LRU cache of decoded images. Entries are keyed by path, modification time and
+file size, so an image that changed on disk is decoded again. Every cache is listed in caches,
+so release can drop an image from all of them.
+"""
+class ImageCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        caches.append(self)
+
+    def get(self, image_path, decode):
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+
+        array = decode(image_path)
+        array.flags.writeable = False  # shared between stages, so nobody may modify it in place
+
+        with self.lock:
+            if array.nbytes <= self.max_bytes:
+                self.images[key] = array
+                self.current_bytes += array.nbytes
+                self.evict()
+        return array
+
+    def evict(self):
+        while self.current_bytes > self.max_bytes and self.images:
+            _, array = self.images.popitem(last=False)
+            self.current_bytes -= array.nbytes
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def discard(self, image_path):
+        path = os.path.abspath(image_path)
+        with self.lock:
+            for key in [key for key in self.images if key[0] == path]:
+                self.current_bytes -= self.images.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.current_bytes = 0
+
+
+caches = []
+cache = ImageCache()
+
+
+# drops an image from every cache once the task that needed it is done, so worker processes don't
+# keep finished images around
+def release(image_path):
+    for image_cache in caches:
+        image_cache.discard(image_path)
+
+
+def is_array_file(image_path):
+    return os.path.splitext(str(image_path))[1].lower() in ARRAY_EXTENSIONS
+
+
+# shape, dtype, channel order and data offset of an array file, from its <file>.json sidecar
+def array_info(image_path):
+    sidecar_path = f'{image_path}.json'
+    info = {'channel_order': 'RGB', 'offset': 0}
+    if os.path.exists(sidecar_path):
+        with open(sidecar_path) as f:
+            info.update(json.load(f))
+    elif not str(image_path).lower().endswith('.npy'):
+        raise ValueError(f'{image_path} needs a {sidecar_path} sidecar giving its shape and dtype')
+    return info
+
+
+"""
+Opens an array file as a read-only memory map of shape (height, width, 3) or, for a stack,
+(frames, height, width, 3). Nothing is read until pixels are used, and then only the pages touched.
+Returns (array, channel_order), channel_order being 'RGB' or 'BGR'.
+"""
+def open_array(image_path):
+    info = array_info(image_path)
+    if str(image_path).lower().endswith('.npy'):
+        array = np.load(image_path, mmap_mode='r')
+    else:
+        array = np.memmap(image_path, dtype=np.dtype(info['dtype']), mode='r', shape=tuple(info['shape']),
+                          offset=info['offset'])
+    if array.dtype != np.uint8 or array.ndim not in (3, 4) or array.shape[-1] != 3:
+        raise ValueError(f'{image_path} must hold uint8 pixels with 3 channels, not {array.dtype} {array.shape}')
+    order = info['channel_order'].upper()
+    if order not in ('RGB', 'BGR'):
+        raise ValueError(f'unknown channel order {order} for {image_path}, use RGB or BGR')
+    return array, order
+
+
+# an array file as RGB or BGR without copying: the channel axis is reversed as a view when needed.
+def load_array(image_path, channel_order='RGB'):
+    array, order = open_array(image_path)
+    return array if order == channel_order else array[..., ::-1]
+
+
+# decodes an image file as an RGB array (height, width, 3) of uint8.
+def decode_rgb(image_path):
+    if is_array_file(image_path):
+        return load_array(image_path)
+    with Profiling.stage('decode'):
+        img = Image.open(image_path)
+        img = img.convert('RGB')  # Ensure image is in RGB mode
+        return np.asarray(img)
+
+
+# decodes an image file as a BGR array exactly as cv2.imread does (EXIF orientation applied, 16-bit
+# images scaled down to 8 bits), for OpenCV-based stages. data is the file's bytes if already read.
+def decode_bgr(image_path, data=None):
+    if is_array_file(image_path):
+        return load_array(image_path, 'BGR')
+    import cv2
+    with Profiling.stage('decode'):
+        if data is None:
+            image = cv2.imread(str(image_path))
+        else:
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'could not read the image {image_path}')
+    return image
+
+
+# returns the decoded RGB array of an image, decoding it only the first time it is requested.
+# The array is read-only; copy it before modifying.
+def load_rgb(image_path):
+    if is_array_file(image_path):
+        return load_array(image_path)  # the OS page cache keeps memory mapped files, no copy is needed
+    return cache.get(image_path, decode_rgb)
+
+
+# page indices of the frames of a multi-page image (z-stack or time series). Pages smaller than the
+# first one are reduced-resolution copies in a pyramid TIFF, not frames, and are left out.
+def stack_frames(image_path):
+    if is_array_file(image_path):
+        array, _ = open_array(image_path)
+        return list(range(len(array))) if array.ndim == 4 else [0]
+    with Image.open(image_path) as img:
+        size = img.size
+        frames = []
+        for index in range(getattr(img, 'n_frames', 1)):
+            img.seek(index)
+            if img.size == size:
+                frames.append(index)
+    return frames
+
+
+# yields (page index, array) for each of the given pages in channel_order ('RGB' or 'BGR'), decoding a page
+# only when it is reached, so a stack of any length is held in memory one frame at a time. Pages are decoded
+# like decode_bgr (16-bit pages scaled down to 8 bits), so a frame gives the same results as a single image.
+def iter_frames(image_path, frames, channel_order='RGB'):
+    if is_array_file(image_path):
+        array = load_array(image_path, channel_order)
+        for index in frames:
+            yield index, array[index] if array.ndim == 4 else array
+        return
+    import cv2
+    for index in frames:
+        with Profiling.stage('decode'):
+            ok, pages = cv2.imreadmulti(str(image_path), start=index, count=1, flags=cv2.IMREAD_COLOR)
+            if not ok or not pages:
+                raise ValueError(f'could not read page {index} of {image_path}')
+            frame = pages[0] if channel_order == 'BGR' else cv2.cvtColor(pages[0], cv2.COLOR_BGR2RGB)
+        yield index, frame
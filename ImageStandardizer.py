@@ -1,37 +1,222 @@
 import os
+import queue
+import threading
 
 import cv2
+import ImageLoader
+import Profiling
+import ResultCache
 
-def white_balance(image):
+# CLAHE settings used by white_balance
+CLAHE_CLIP_LIMIT = 3.0
+CLAHE_TILE_GRID = (8, 8)
+
+# Output settings: format is the file extension, PNG compression is 0-9 (None for the OpenCV default)
+OUTPUT_DIR = 'StandardizedImages'
+OUTPUT_FORMAT = 'png'
+PNG_COMPRESSION = None
+
+# Batch pipeline: threads reading/decoding and encoding/writing, and images allowed to wait between stages
+READ_THREADS = 2
+WRITE_THREADS = 2
+QUEUE_SIZE = 4
+
+# one CLAHE object per thread, they are not safe to share between threads
+local = threading.local()
+
+# white balanced images kept in memory, so chained analyses and the standardized file share one white_balance
+standardized_cache = ImageLoader.ImageCache()
+
+
+def get_clahe():
+    if getattr(local, 'clahe', None) is None:
+        local.clahe = cv2.createCLAHE(clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=CLAHE_TILE_GRID)
+    return local.clahe
+
+
+# is_rgb=True takes an RGB array (e.g. from ImageLoader) directly, the result is always BGR.
+def white_balance(image, is_rgb=False):
     # Convert image to LAB color space
-    lab = cv2.cvtColor(image, cv2.COLOR_BGR2Lab)
-    l, a, b = cv2.split(lab)
+    with Profiling.stage('color_convert'):
+        lab = cv2.cvtColor(image, cv2.COLOR_RGB2Lab if is_rgb else cv2.COLOR_BGR2Lab)
+        l, a, b = cv2.split(lab)
 
     # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) to L channel
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    cl = clahe.apply(l)
-    limg = cv2.merge((cl, a, b))
+    with Profiling.stage('clahe'):
+        cl = get_clahe().apply(l)
 
     # Convert back to BGR color space
-    return cv2.cvtColor(limg, cv2.COLOR_Lab2BGR)
+    with Profiling.stage('color_convert'):
+        limg = cv2.merge((cl, a, b))
+        return cv2.cvtColor(limg, cv2.COLOR_Lab2BGR)
+
+
+# white balanced BGR array of an image file
+def balance_file(image_path):
+    if ImageLoader.is_array_file(image_path):
+        # memory mapped arrays go to OpenCV in their stored channel order, so they are never copied first
+        array, order = ImageLoader.open_array(image_path)
+        return white_balance(array, is_rgb=order == 'RGB')
+    return white_balance(ImageLoader.decode_bgr(image_path))
+
+
+# white balanced BGR array of an image, computed only the first time it is requested. The array is read-only.
+def load_standardized(image_path):
+    return standardized_cache.get(image_path, balance_file)
+
+
+# the settings that change what white_balance produces, for cache keys of analyses run on standardized images
+def settings():
+    return {'clip_limit': CLAHE_CLIP_LIMIT, 'tile_grid': CLAHE_TILE_GRID}
+
+
+def output_path_for(image_path, output_format=OUTPUT_FORMAT, output_dir=OUTPUT_DIR):
+    return f'{output_dir}/{image_path.split('/')[-1].split('\\')[-1]}_standardized.{output_format}'
+
+
+def encode_params(output_format=OUTPUT_FORMAT, png_compression=PNG_COMPRESSION):
+    if output_format.lower() == 'png' and png_compression is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+    return []
+
+
+def cache_params(output_path, png_compression=PNG_COMPRESSION):
+    return {**settings(), 'output': output_path, 'png_compression': png_compression}
 
 
 # main function that converts image to correct format, and then calls white_balance, and writes image to file.
-def standardize_image(image_path):
-    # Load the image
-    image = cv2.imread(image_path)
+# Returns the path of the standardized image.
+def standardize_image(image_path, output_format=OUTPUT_FORMAT, png_compression=PNG_COMPRESSION,
+                      output_dir=OUTPUT_DIR):
+    output_path = output_path_for(image_path, output_format, output_dir)
+
+    def standardize():
+        # Load and white balance the image, shared with any analysis chained after it
+        balanced_image = load_standardized(image_path)
+
+        # Create output directory if it doesn't exist
+        os.makedirs(output_dir, exist_ok=True)  # Creates the directory if it doesn't exist
+
+        # write the image to output
+        with Profiling.stage('encode'):
+            cv2.imwrite(output_path, balanced_image, encode_params(output_format, png_compression))
+        return output_path
+
+    # skip images whose standardized output was already written from the same contents and settings
+    params = cache_params(output_path, png_compression)
+    return ResultCache.cached('standardize', image_path, params, standardize, output_paths=[output_path])
+
+
+# marks the end of the items sent to a pipeline stage
+STOP = object()
+
+
+# the output of an image whose standardized file is already up to date, passed through the later stages untouched
+class Done:
+    def __init__(self, output_path):
+        self.output_path = output_path
 
-    # Perform white balance
-    balanced_image = white_balance(image)
 
-    # Create output directory if it doesn't exist
-    output_dir = 'StandardizedImages'
+"""
+Starts threads running func on every item of inbox and putting what it returns in outbox, until
+inbox yields STOP. Items are (image_path, value, error) tuples; items with an error or a Done value
+pass through untouched. When the last thread finishes, STOP is passed on to outbox.
+"""
+def start_stage(func, inbox, outbox, threads):
+    remaining = [threads]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            item = inbox.get()
+            if item is STOP:
+                inbox.put(STOP)  # let the other threads of this stage see it too
+                break
+            image_path, value, error = item
+            if error is None and not isinstance(value, Done):
+                try:
+                    value = func(image_path, value)
+                except Exception as e:
+                    value, error = None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})'
+            outbox.put((image_path, value, error))
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                outbox.put(STOP)
+
+    for _ in range(threads):
+        threading.Thread(target=work, daemon=True).start()
+
+
+"""
+Standardizes a batch of images with reading/decoding, white balance and encoding/writing running
+at the same time in separate threads, so disk or network I/O overlaps with compute. Bounded queues
+between the stages keep at most queue_size decoded images waiting at each step. The read threads
+also look each image up in the result cache, hashing the bytes they read, and images whose output is
+already up to date skip the other stages.
+Returns the output paths in the same order as image_paths, with None for images that failed.
+"""
+def standardize_batch(image_paths, output_format=OUTPUT_FORMAT, png_compression=PNG_COMPRESSION,
+                      workers=None, queue_size=QUEUE_SIZE, output_dir=OUTPUT_DIR):
+    workers = workers or os.cpu_count() or 1
+    extension = f'.{output_format}'
+    params = encode_params(output_format, png_compression)
     os.makedirs(output_dir, exist_ok=True)  # Creates the directory if it doesn't exist
+    use_cache = ResultCache.enabled()
+    keys = {}
+
+    def read(image_path, _):
+        if not use_cache:
+            return ImageLoader.decode_bgr(image_path)
+        # skip images whose standardized output was already written from the same contents and settings
+        output_path = output_path_for(image_path, output_format, output_dir)
+        data = None
+        if not ImageLoader.is_array_file(image_path):
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        keys[image_path] = ResultCache.cache_key('standardize', image_path,
+                                                 cache_params(output_path, png_compression), data)
+        if ResultCache.from_outputs(ResultCache.cache.get(keys[image_path]), [output_path]) is not None:
+            return Done(output_path)
+        return ImageLoader.decode_bgr(image_path, data)
+
+    def balance(image_path, image):
+        return white_balance(image)
+
+    def write(image_path, balanced_image):
+        ok, encoded = cv2.imencode(extension, balanced_image, params)
+        if not ok:
+            raise ValueError(f'could not encode as {output_format}')
+        output_path = output_path_for(image_path, output_format, output_dir)
+        with open(output_path, 'wb') as f:
+            f.write(encoded)
+        return output_path
+
+    paths, decoded, balanced, written = queue.Queue(), queue.Queue(queue_size), queue.Queue(queue_size), queue.Queue()
+    start_stage(read, paths, decoded, READ_THREADS)
+    start_stage(balance, decoded, balanced, workers)
+    start_stage(write, balanced, written, WRITE_THREADS)
+
+    for image_path in image_paths:
+        paths.put((image_path, None, None))
+    paths.put(STOP)
 
-    # write the image to output
-    cv2.imwrite(f'StandardizedImages/{image_path.split('/')[-1].split('\\')[-1]}_standardized.png', balanced_image)
+    # new results are cached from this thread, the read threads only look them up
+    outputs = {}
+    for done, (image_path, output, error) in enumerate(iter(written.get, STOP), start=1):
+        if error:
+            print(error)
+        elif isinstance(output, Done):
+            outputs[image_path] = output.output_path
+        else:
+            outputs[image_path] = output
+            if image_path in keys:
+                ResultCache.cache.put(keys[image_path], 'standardize', image_path,
+                                      ResultCache.with_outputs(output, [output]))
+        print(f'Processed {done}/{len(image_paths)} images.')
+    return [outputs.get(image_path) for image_path in image_paths]
 
 
 if __name__ == '__main__':
     img_path = input('Please enter the image path: ')
-    standardize_image(img_path)
\ No newline at end of file
+    standardize_image(img_path)
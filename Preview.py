@@ -0,0 +1,132 @@
+"""
+Display-size previews for the selection windows.
+
+Previews are decoded at reduced resolution where the format allows it (JPEG draft mode, or
+the smallest sufficient page of a multi-resolution TIFF) and saved in PreviewCache, keyed by
+the image's path, modification time and file size and the preview size, so reopening an image
+skips the decode entirely without reading the file to hash it.
+The caller picks the preview size from image_size(), so it can map clicks back to full-resolution
+pixels exactly as it would with a resized full decode.
+
+Analyses decoding with PIL see images as stored; those decoding with cv2.imread see them rotated by
+their EXIF orientation and, for 16-bit images, scaled down to 8 bits. Their windows ask for oriented
+previews (oriented=True), and check same_as_cv2 before using a preview at all: PIL cannot scale 16-bit
+pixels the way cv2.imread does, so such images are shown from the decoded image instead.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+import ImageLoader
+
+PREVIEW_DIR = 'PreviewCache'
+
+
+# EXIF orientation -> the transpose that shows the image upright (as ImageOps.exif_transpose does)
+ORIENTATION_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def orientation(img):
+    return img.getexif().get(0x0112, 1)
+
+
+# full-resolution (width, height) of an image, read from its header without decoding pixels. With
+# oriented, the size after the EXIF orientation is applied, as cv2.imread returns it.
+def image_size(image_path, oriented=False):
+    if ImageLoader.is_array_file(image_path):
+        array, _ = ImageLoader.open_array(image_path)
+        return array.shape[1], array.shape[0]
+    with Image.open(image_path) as img:
+        width, height = img.size
+        if oriented and orientation(img) in TRANSPOSED_ORIENTATIONS:
+            return height, width
+        return width, height
+
+
+# whether PIL decodes an image to the same 8-bit pixels as cv2.imread (up to orientation), i.e. it
+# is not stored with more than 8 bits per sample
+def same_as_cv2(image_path):
+    if ImageLoader.is_array_file(image_path):
+        return True
+    with Image.open(image_path) as img:
+        args = img.tile[0][3] if img.tile else ''
+        rawmode = args[0] if isinstance(args, tuple) else args
+        return not (img.mode.startswith(('I', 'F')) or ';16' in str(rawmode) or ';32' in str(rawmode))
+
+
+# preview of a memory mapped array: every step-th row and column is read, not the whole array.
+def array_preview(image_path, size):
+    rgb = ImageLoader.load_array(image_path)
+    step = max(1, min(rgb.shape[1] // size[0], rgb.shape[0] // size[1]))
+    return Image.fromarray(np.ascontiguousarray(rgb[::step, ::step]))
+
+
+# switches img to the cheapest decode that still gives at least size pixels.
+def reduce_decode(img, size):
+    full_width, full_height = img.size
+
+    # TIFF pyramids store each resolution as a page: pick the smallest page that is big enough
+    if img.format == 'TIFF' and getattr(img, 'n_frames', 1) > 1:
+        best_page, best_width = 0, full_width
+        for page in range(1, img.n_frames):
+            img.seek(page)
+            width, height = img.size
+            same_aspect = abs(width / height - full_width / full_height) < 0.01
+            if same_aspect and size[0] <= width < best_width and height >= size[1]:
+                best_page, best_width = page, width
+        img.seek(best_page)
+
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale directly
+    img.draft('RGB', size)
+    return img
+
+
+# cache file of a preview. An image that is modified or replaced gets a new entry, found from its stat alone.
+def preview_path(image_path, size, oriented=False):
+    stat = os.stat(image_path)
+    source = f'{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}'
+    suffix = '_oriented' if oriented else ''
+    return os.path.join(PREVIEW_DIR, f'{hashlib.sha256(source.encode()).hexdigest()}_{size[0]}x{size[1]}{suffix}.png')
+
+
+# RGB PIL image of image_path at exactly size (width, height), from the preview cache when possible.
+# With oriented, the preview is rotated by the image's EXIF orientation, and size is the oriented size.
+def load_preview(image_path, size, oriented=False):
+    size = (max(1, int(size[0])), max(1, int(size[1])))
+    cached_path = preview_path(image_path, size, oriented)
+    if os.path.exists(cached_path):
+        try:
+            with Image.open(cached_path) as cached:
+                return cached.convert('RGB')
+        except OSError:
+            pass  # unreadable cache entry (e.g. an interrupted write), make it again
+
+    if ImageLoader.is_array_file(image_path):
+        preview = array_preview(image_path, size).resize(size, Image.Resampling.BICUBIC)
+    else:
+        with Image.open(image_path) as img:
+            turn = orientation(img) if oriented else 1
+            stored_size = (size[1], size[0]) if turn in TRANSPOSED_ORIENTATIONS else size
+            img = reduce_decode(img, stored_size).convert('RGB')
+            preview = img.resize(stored_size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+            if turn in ORIENTATION_TRANSPOSES:
+                preview = preview.transpose(ORIENTATION_TRANSPOSES[turn])
+
+    os.makedirs(PREVIEW_DIR, exist_ok=True)  # Creates the preview directory if it doesn't exist
+    temp_path = f'{cached_path}.{os.getpid()}.tmp'
+    preview.save(temp_path, 'PNG', compress_level=1)
+    os.replace(temp_path, cached_path)  # other processes never see a half written preview
+    return preview
@@ -0,0 +1,213 @@
+"""
+Opt-in stage timing for the image pipeline.
+
+Set the LND_PROFILE environment variable to a file path (or call enable(path)) and every image
+processed inside image_record() appends one JSON line to that file:
+
+    {"image": ..., "pid": ..., "seconds": ..., "error": null,
+     "stages": {"decode": {"seconds": ..., "peak_rss_mb": ..., "rss_delta_mb": ...}, ...}}
+
+peak_rss_mb is the highest resident memory of the process while the stage (or image) ran, and
+rss_delta_mb how much resident memory it left behind. On Linux the high-water mark is reset at the
+start of every stage and image through /proc/self/clear_refs; where that is not possible stages get
+null and the image gets the high-water mark of the whole process. Memory is per process, so with
+several images on threads of one process the numbers include the other threads' work.
+
+Stages are timed with `with Profiling.stage("name"):`. When profiling is off, stage() returns a
+shared do-nothing context manager, so instrumented code pays one function call per stage.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module, memory is not reported there
+    resource = None
+
+ENV_VAR = 'LND_PROFILE'
+
+records_path = os.environ.get(ENV_VAR) or None
+local = threading.local()
+write_lock = threading.Lock()
+NO_STAGE = contextlib.nullcontext()
+
+
+# turns profiling on, writing records to path. Worker processes started afterwards inherit it.
+def enable(path):
+    global records_path
+    records_path = path
+    os.environ[ENV_VAR] = path
+
+
+def disable():
+    global records_path
+    records_path = None
+    os.environ.pop(ENV_VAR, None)
+
+
+def enabled():
+    return records_path is not None
+
+
+# process memory high-water mark since the process started, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+# current resident memory in MB, or None where /proc is not available
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# resets the process memory high-water mark (Linux only). Returns whether it was reset.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# memory high-water mark since the last reset_peak_rss, in MB
+def peak_since_reset_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+"""
+High-water mark of one stage or image. Resetting the process mark for an inner stage would hide what
+the enclosing ones used before it, so every open measurement on this thread keeps its own running
+maximum, and a measurement that ends passes its peak on to the ones still open.
+"""
+class PeakMemory:
+    def __init__(self):
+        self.reset = reset_peak_rss()
+        self.peak = 0.0
+        self.start_rss = current_rss_mb()
+        local.peaks = getattr(local, 'peaks', []) + [self]
+
+    # returns (peak MB, resident MB gained), None where they cannot be measured
+    def finish(self):
+        local.peaks = [peak for peak in local.peaks if peak is not self]
+        end_rss = current_rss_mb()
+        delta = end_rss - self.start_rss if end_rss is not None and self.start_rss is not None else None
+        if not self.reset:
+            return None, delta
+        self.peak = max(self.peak, peak_since_reset_mb() or 0.0)
+        for outer in local.peaks:
+            outer.peak = max(outer.peak, self.peak)
+        return self.peak, delta
+
+
+class Stage:
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.memory = PeakMemory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        peak, delta = self.memory.finish()
+        stage = self.record['stages'].setdefault(self.name, {'seconds': 0.0, 'peak_rss_mb': None, 'rss_delta_mb': None})
+        stage['seconds'] += seconds  # a stage that runs more than once per image is summed
+        if peak is not None:
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'] or 0.0, peak)  # and keeps its highest peak
+        if delta is not None:
+            stage['rss_delta_mb'] = (stage['rss_delta_mb'] or 0.0) + delta
+        return False
+
+
+# times a named stage of the image currently being recorded on this thread.
+def stage(name):
+    record = getattr(local, 'record', None) if records_path is not None else None
+    if record is None:
+        return NO_STAGE
+    return Stage(record, name)
+
+
+# collects the stages of one image and appends its record to the JSON-lines file when done.
+@contextlib.contextmanager
+def image_record(image_path):
+    if records_path is None:
+        yield None
+        return
+
+    record = {'image': str(image_path), 'pid': os.getpid(), 'seconds': None, 'error': None, 'stages': {}}
+    previous = getattr(local, 'record', None)
+    local.record = record
+    memory = PeakMemory()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        peak, record['rss_delta_mb'] = memory.finish()
+        record['peak_rss_mb'] = peak if peak is not None else peak_rss_mb()
+        local.record = previous
+        line = json.dumps(record) + '\n'
+        with write_lock, open(records_path, 'a') as f:
+            f.write(line)  # one write per record so concurrent workers don't interleave lines
+
+
+# current size of the records file, so a summary can cover only the records written after it.
+def records_offset():
+    if records_path is None or not os.path.exists(records_path):
+        return 0
+    return os.path.getsize(records_path)
+
+
+def read_records(path, offset=0):
+    with open(path) as f:
+        f.seek(offset)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+# p50/p95 seconds per stage (and for whole images) over a list of records.
+def summarize(records):
+    timings = {}
+    for record in records:
+        timings.setdefault('total', []).append(record['seconds'])
+        for name, stage_record in record['stages'].items():
+            timings.setdefault(name, []).append(stage_record['seconds'])
+    return {name: {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+            for name, values in timings.items()}
+
+
+def print_summary(summary):
+    print(f"{'Stage':>16} {'Images':>7} {'p50 (s)':>9} {'p95 (s)':>9}")
+    for name, stats in summary.items():
+        print(f"{name:>16} {stats['count']:>7} {stats['p50']:>9.4f} {stats['p95']:>9.4f}")
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else input('Please enter the profile records path: ')
+    print_summary(summarize(read_records(path)))
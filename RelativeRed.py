@@ -1,64 +1,131 @@
+import csv
 from PIL import Image
 import numpy as np
-import SelectArea
+import ImageLoader
+import Profiling
+import ResultCache
 
+# Pixels per chunk when building histograms
+HISTOGRAM_CHUNK_PIXELS = 1 << 22
 
-def redscale_image(image_path):
-    # Open the image
-    img = Image.open(image_path)
-    img = img.convert('RGB')  # Ensure image is in RGB mode
 
-    # Prepare a new image for the redscale result
-    redscaled_img = Image.new('RGB', img.size)
+# computes how dominant red is in each pixel for a whole RGB array at once, returns the red channel as uint8.
+# matches the per-pixel int(r - 0.5 * g - 0.5 * b) clipped to 0-255: the value is never above 255,
+# and int() of a negative value is clipped to 0, so (2r - g - b) // 2 floored at 0 gives the same result.
+def redscale_array(rgb_array):
+    red = rgb_array[..., 0].astype(np.int16)
+    red *= 2
+    red -= rgb_array[..., 1]
+    red -= rgb_array[..., 2]
+    np.maximum(red, 0, out=red)
+    red >>= 1
+    return red.astype(np.uint8)
 
-    for x in range(img.width):
-        for y in range(img.height):
-            # Get pixel color
-            r, g, b = img.getpixel((x, y))
 
-            # Recolor pixels based on how dominant red is in that pixel
-            redscaled_color = (int(r - 0.5 * g - 0.5 * b), 0, 0)
-            redscaled_img.putpixel((x, y), redscaled_color)
+def redscale_image(image_path):
+    red_channel = redscale_array(ImageLoader.load_rgb(image_path))
+
+    # Prepare a new image for the redscale result
+    redscaled_array = np.zeros(red_channel.shape + (3,), dtype=np.uint8)
+    redscaled_array[..., 0] = red_channel
+    redscaled_img = Image.fromarray(redscaled_array)
 
     #  ENABLE THIS TO SEE RED-FILTERED IMAGE:
     # redscaled_img.show()
     return redscaled_img
 
 
-# takes in the full image as an array with just the red chanel, returns red pixel count from selected areas.
-def red_pixels_in_area(red_channel, image_path, threshold):
-    coords = SelectArea.select_areas(image_path)
-    total_sum = 0
+# builds a summed-area table of a boolean mask, padded with a leading row and column of zeros,
+# so the count of True values in any rectangle can be read from four corners.
+def summed_area_table(mask):
+    dtype = np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+# clips rectangle coordinates (x1, y1, x2, y2) to the image so they behave like array slices.
+def clip_coords(coords, height, width):
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 4)
+    x1, y1, x2, y2 = (coords[:, i] for i in range(4))
+    x1, x2 = np.clip(x1, 0, width), np.clip(x2, 0, width)
+    y1, y2 = np.clip(y1, 0, height), np.clip(y2, 0, height)
+    return x1, y1, np.maximum(x2, x1), np.maximum(y2, y1)
+
+
+# sums the pixels in each rectangle from a summed-area table, overlapping areas are counted once per rectangle.
+def count_in_areas(table, coords):
+    x1, y1, x2, y2 = clip_coords(coords, table.shape[0] - 1, table.shape[1] - 1)
+    counts = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+    return int(counts.sum())
+
+
+# how many rectangles cover each pixel of a height x width image.
+def area_coverage(coords, height, width):
+    x1, y1, x2, y2 = clip_coords(coords, height, width)
+
+    # mark rectangle corners, then a 2D prefix sum gives how many rectangles cover each pixel
+    coverage = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(coverage, (y1, x1), 1)
+    np.add.at(coverage, (y1, x2), -1)
+    np.add.at(coverage, (y2, x1), -1)
+    np.add.at(coverage, (y2, x2), 1)
+    np.cumsum(coverage, axis=0, out=coverage)
+    np.cumsum(coverage, axis=1, out=coverage)
+    return coverage[:height, :width]
+
+
+# counts the pixels of a mask covered by at least one rectangle, so overlapping areas are only counted once.
+def count_in_area_union(mask, coords):
+    coverage = area_coverage(coords, *mask.shape)
+    return int(np.count_nonzero(mask & (coverage > 0)))
+
 
-    # loop through each selected area, adding the number of red pixels above the threshold to the count.
-    for coord in coords:
-        x1, y1, x2, y2 = coord[0], coord[1], coord[2], coord[3]
-        red_channel_area = red_channel[y1:y2, x1:x2]
-        area_mask = red_channel_area > threshold
-        total_sum += np.sum(area_mask)
-    return total_sum
+# gets the selected areas for an image, from a saved ROI file/directory if given, otherwise from the selection window.
+def get_areas(image_path, roi_path=None):
+    import SelectArea  # tkinter is loaded by the runs that need areas, not by every importer of this module
+    if roi_path:
+        return SelectArea.load_areas(roi_path, image_path)
+    return SelectArea.select_areas(image_path)
 
 
-def percentage_red_pixels(image_path, red_threshold = 30):
-    red_image = redscale_image(image_path)
+"""
+Takes in the red mask (pixels above the threshold) of the full image, returns red pixel count from selected areas.
+With union=True pixels inside overlapping areas are counted once, otherwise once per area they fall in.
+"""
+def red_pixels_in_area(red_mask, coords, union=False):
+    if len(coords) == 0:
+        return 0
 
-    # Convert the image to RGB (if not already) and then to a NumPy array
-    img_array = np.array(red_image.convert('RGB'))
+    with Profiling.stage('area_count'):
+        if union:
+            return count_in_area_union(red_mask, coords)
+        return count_in_areas(summed_area_table(red_mask), coords)
 
+
+# red percentage of a whole RGB array and of the selected areas within it.
+def red_percentages(rgb_array, coords, red_threshold = 30, union = False):
     # Extract the red channel from the image
-    red_channel = img_array[..., 0]  # 0 = red
+    with Profiling.stage('redscale'):
+        red_channel = redscale_array(rgb_array)
+    return red_channel_percentages(red_channel, coords, red_threshold, union)
+
 
-    # Create a boolean mask for the image to find red pixels above the threshold
-    red_mask = red_channel > red_threshold
+# red_percentages for a red channel that was already computed, e.g. a max projection of a stack.
+def red_channel_percentages(red_channel, coords, red_threshold = 30, union = False):
+    with Profiling.stage('threshold'):
+        # Create a boolean mask for the image to find red pixels above the threshold
+        red_mask = red_channel > red_threshold
 
-    # Calculate the total number of pixels
-    total_pixels = img_array.shape[0] * img_array.shape[1]
+        # Calculate the total number of pixels
+        total_pixels = red_channel.shape[0] * red_channel.shape[1]
 
-    # Count the number of red pixels in whole image
-    red_pixel_count = np.sum(red_mask)
+        # Count the number of red pixels in whole image
+        red_pixel_count = np.count_nonzero(red_mask)
 
     # get the count of pixels from selected area
-    area_red_pixels = red_pixels_in_area(red_channel, image_path, red_threshold)
+    area_red_pixels = red_pixels_in_area(red_mask, coords, union)
 
     # Calculate the percentage of red pixels
     red_percentage = (red_pixel_count / total_pixels) * 100 if total_pixels > 0 else 0
@@ -67,15 +134,110 @@ def percentage_red_pixels(image_path, red_threshold = 30):
     return red_percentage, area_red_percentage
 
 
-def get_relative_red(image_path, threshold = 30):
-    whole_red_percentage, selected_red_percentage = percentage_red_pixels(image_path, threshold)
+# the RGB array analysed for an image: as decoded, or white balanced in memory when standardize is set.
+def load_rgb(image_path, standardize = False):
+    if standardize:
+        import ImageStandardizer  # OpenCV is only loaded by standardized runs
+        return ImageStandardizer.load_standardized(image_path)[..., ::-1]  # BGR to RGB as a view, no copy
+    return ImageLoader.load_rgb(image_path)
+
+
+def percentage_red_pixels(image_path, red_threshold = 30, roi_path = None, union = False, standardize = False):
+    # get the selected areas first, they are part of the key of the cached result
+    with Profiling.stage('select_areas'):
+        coords = get_areas(image_path, roi_path)
+
+    params = {'threshold': red_threshold, 'union': union, 'areas': coords}
+    if standardize:
+        import ImageStandardizer
+        params['standardize'] = ImageStandardizer.settings()
+    red_percentage, area_red_percentage = ResultCache.cached(
+        'relative_red', image_path, params,
+        lambda: red_percentages(load_rgb(image_path, standardize), coords, red_threshold, union))
+    return red_percentage, area_red_percentage
+
+
+# red percentages of an image as a record for ResultsStore, format_relative_red turns it into the printed summary.
+def get_relative_red(image_path, threshold = 30, roi_path = None, union = False, standardize = False):
+    whole_red_percentage, selected_red_percentage = percentage_red_pixels(image_path, threshold, roi_path, union,
+                                                                          standardize)
+    params = {'red_threshold': threshold, 'roi_path': roi_path, 'union': union, 'standardize': standardize}
+    return relative_red_record(image_path, whole_red_percentage, selected_red_percentage, params)
+
+
+def relative_red_record(image_path, whole_red_percentage, selected_red_percentage, params):
+    return {
+        'analysis': 'relative_red',
+        'image': image_path,
+        'params': params,
+        'rows': [
+            {'class': 'Whole image', 'red_percent': float(whole_red_percentage)},
+            {'class': 'Selected area', 'red_percent': float(selected_red_percentage)},
+        ],
+    }
+
+
+def format_relative_red(record):
+    image_path = record['image']
+    whole_red_percentage, selected_red_percentage = (row['red_percent'] for row in record['rows'])
     output = f'''\nThe image {image_path.split("/")[-1].split("\\")[-1]} is {round(whole_red_percentage, 3)}% red.
 The selected area makes up {round(selected_red_percentage, 3)}% of the red in the image.\n'''
 
     return output
 
 
+# histogram of red channel values (256 bins), optionally weighting each pixel. Done in row chunks to bound memory.
+def red_histogram(red_channel, weights=None):
+    histogram = np.zeros(256, dtype=np.float64 if weights is not None else np.int64)
+    rows = max(1, HISTOGRAM_CHUNK_PIXELS // max(red_channel.shape[1], 1))
+    for y in range(0, red_channel.shape[0], rows):
+        chunk_weights = None if weights is None else weights[y:y + rows].ravel()
+        histogram += np.bincount(red_channel[y:y + rows].ravel(), weights=chunk_weights, minlength=256)
+    return histogram
+
+
+"""
+Red percentage of the whole image and of the selected areas for every threshold 0-255 at once,
+from one histogram of the image and one of the areas. Index t of each array is what
+percentage_red_pixels would return with red_threshold = t.
+"""
+def red_threshold_sweep(image_path, roi_path = None, union = False):
+    coords = get_areas(image_path, roi_path)
+    red_channel = redscale_array(ImageLoader.load_rgb(image_path))
+    total_pixels = red_channel.shape[0] * red_channel.shape[1]
+
+    whole_histogram = red_histogram(red_channel)
+    area_histogram = np.zeros(256)
+    if len(coords) > 0:
+        # weighting pixels by how many areas cover them counts overlaps like red_pixels_in_area does
+        coverage = area_coverage(coords, *red_channel.shape)
+        area_histogram = red_histogram(red_channel, coverage > 0 if union else coverage)
+
+    # pixels above threshold t are all the pixels minus those with values 0..t
+    whole_above = whole_histogram.sum() - np.cumsum(whole_histogram)
+    area_above = area_histogram.sum() - np.cumsum(area_histogram)
+    scale = 100 / total_pixels if total_pixels > 0 else 0
+    return {
+        'image': image_path.split("/")[-1].split("\\")[-1],
+        'whole': whole_above * scale,
+        'area': area_above * scale,
+    }
+
+
+# writes threshold sweeps as a table with one row per image and measure, and one column per threshold.
+def write_sweep_table(output_path, sweeps):
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Image', 'Measure', *range(256)])
+        for sweep in sweeps:
+            writer.writerow([sweep['image'], 'Whole image red (%)', *np.round(sweep['whole'], 4)])
+            writer.writerow([sweep['image'], 'Selected area red (%)', *np.round(sweep['area'], 4)])
+    print(f'Threshold sweep saved as {output_path}')
+
+
 if __name__ == '__main__':
     path = input('Please enter the image path: ')
     threshold = int(input('Please enter the red threshold (0-255): '))
-    print(get_relative_red(path, threshold))
+    roi_path = input('Please enter a saved areas file/directory (leave blank to select areas): ')
+    union = input('Count overlapping areas once? (y/n): ').lower().startswith('y')
+    print(format_relative_red(get_relative_red(path, threshold, roi_path or None, union)))
@@ -0,0 +1,198 @@
+"""
+On-disk cache of analysis results, so unchanged images are not analysed again.
+
+Results are keyed by the SHA-256 of the image file contents (plus the sidecar describing a raw
+array file), the analysis name, its parameters and CODE_VERSION, and stored as JSON in a local SQLite file. The least recently used results
+are evicted once the cache grows past its size limit.
+
+    python ResultCache.py --stats
+    python ResultCache.py --invalidate [--analysis relative_red] [--image path/to/image.tif]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Bump whenever an analysis changes what it returns for the same image and parameters
+CODE_VERSION = 2
+
+# LND_CACHE sets the database path; 'off' disables caching
+CACHE_PATH = os.environ.get('LND_CACHE', 'ResultCache.sqlite')
+CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+HASH_CHUNK_BYTES = 1024 ** 2
+
+
+# file digests already computed by this process, keyed by path, mtime and size
+digests = {}
+
+
+# SHA-256 of a file's contents, read in chunks so large slides are not loaded at once. Callers that
+# have already read the whole file pass its bytes as data, so it is not read a second time.
+def file_digest(path, data=None):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in digests:
+        if data is not None:
+            digests[key] = hashlib.sha256(data).hexdigest()
+            return digests[key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                sha.update(chunk)
+        digests[key] = sha.hexdigest()
+    return digests[key]
+
+
+def cache_key(analysis, image_path, params, data=None):
+    import ImageLoader
+    description = {
+        'analysis': analysis,
+        'image': file_digest(image_path, data),
+        'params': params,
+        'version': CODE_VERSION,
+    }
+    if ImageLoader.is_array_file(image_path):
+        # the <file>.json sidecar decides how the bytes are read (shape, dtype, channel order)
+        description['array_info'] = ImageLoader.array_info(image_path)
+    description = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    # opens the database lazily, once per thread and again in each worker process (connections can't
+    # cross a fork or be shared between threads)
+    def db(self):
+        if getattr(self.local, 'connection', None) is None or self.local.pid != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=30)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, analysis TEXT, image TEXT, value TEXT, size INTEGER, last_used REAL)''')
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get(self, key):
+        with self.db() as db:
+            row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, analysis, image_path, value):
+        value = json.dumps(value)
+        with self.db() as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, analysis, os.path.abspath(image_path), value, len(value), time.time()))
+        self.evict()
+
+    # drops least recently used results until the cache fits in max_bytes
+    def evict(self):
+        with self.db() as db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = db.execute('SELECT key, size FROM results ORDER BY last_used').fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            db.executemany('DELETE FROM results WHERE key = ?', stale)
+
+    # removes cached results, all of them or only those of one analysis and/or image. Returns the count removed.
+    def invalidate(self, analysis=None, image_path=None):
+        query, args = 'DELETE FROM results WHERE 1', []
+        if analysis:
+            query += ' AND analysis = ?'
+            args.append(analysis)
+        if image_path:
+            query += ' AND image = ?'
+            args.append(os.path.abspath(image_path))
+        with self.db() as db:
+            return db.execute(query, args).rowcount
+
+    def stats(self):
+        with self.db() as db:
+            return db.execute('''SELECT analysis, COUNT(*), COALESCE(SUM(size), 0)
+                                 FROM results GROUP BY analysis''').fetchall()
+
+
+cache = ResultCache()
+
+
+def enabled():
+    return CACHE_PATH.lower() != 'off'
+
+
+# modification time and size of each output file, or None if one is missing
+def output_stamps(output_paths):
+    try:
+        stats = [os.stat(path) for path in output_paths]
+    except FileNotFoundError:
+        return None
+    return [[stat.st_mtime_ns, stat.st_size] for stat in stats]
+
+
+# what is cached for a result that wrote output_paths: the result and the stamps of the files it wrote
+def with_outputs(value, output_paths):
+    return {'value': value, 'outputs': output_stamps(output_paths)}
+
+
+# the result of an entry made by with_outputs, or None if its files were deleted or written again since
+def from_outputs(entry, output_paths):
+    if entry is None or entry['outputs'] is None or entry['outputs'] != output_stamps(output_paths):
+        return None
+    return entry['value']
+
+
+"""
+Returns the cached result of analysis on image_path with params, or calls compute() and caches
+what it returns. Results must be JSON serializable (tuples come back as lists). If the analysis
+writes files, give their paths as output_paths: a cached result is then only used while those files
+are the ones it wrote, so a run with other settings that overwrote them is not reported as current.
+"""
+def cached(analysis, image_path, params, compute, output_paths=()):
+    if not enabled():
+        return compute()
+    key = cache_key(analysis, image_path, params)
+    if output_paths:
+        value = from_outputs(cache.get(key), output_paths)
+        if value is None:
+            value = compute()
+            cache.put(key, analysis, image_path, with_outputs(value, output_paths))
+        return value
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.put(key, analysis, image_path, value)
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or clear the analysis result cache.')
+    parser.add_argument('--invalidate', action='store_true', help='remove cached results')
+    parser.add_argument('--analysis', help='only remove results of this analysis')
+    parser.add_argument('--image', help='only remove results of this image')
+    parser.add_argument('--stats', action='store_true', help='show cached results per analysis')
+    args = parser.parse_args(argv)
+
+    if args.invalidate:
+        print(f'Removed {cache.invalidate(args.analysis, args.image)} cached results from {cache.path}.')
+    if args.stats or not args.invalidate:
+        for analysis, count, size in cache.stats():
+            print(f'{analysis}: {count} results, {size / 1024:.1f} KB')
+
+
+if __name__ == '__main__':
+    main()
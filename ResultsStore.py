@@ -0,0 +1,135 @@
+"""
+One SQLite database holding the numeric results of every batch, instead of a file per image.
+
+Analyses return records like
+
+    {'analysis': 'relative_red', 'image': 'slides/a.tif', 'params': {'red_threshold': 30, ...},
+     'rows': [{'class': 'Whole image', 'red_percent': 12.5}, {'class': 'Selected area', 'red_percent': 3.1}]}
+
+and ResultsStore.add() buffers them, writing one value per (image, class, measure) in bulk. Each
+distinct analysis and parameter set becomes a run, so results stay queryable by the settings used:
+
+    SELECT image, value FROM results JOIN runs USING (run_id)
+    WHERE analysis = 'lipid_nuclei' AND class = 'Nuclei' AND measure = 'percent'
+
+    python ResultsStore.py --runs
+    python ResultsStore.py --export results.csv [--analysis relative_red]
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+
+# LND_RESULTS sets the database path
+RESULTS_PATH = os.environ.get('LND_RESULTS', 'Results.sqlite')
+
+# rows buffered before they are written in one transaction
+FLUSH_ROWS = 10000
+
+
+class ResultsStore:
+    def __init__(self, path=RESULTS_PATH, flush_rows=FLUSH_ROWS):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY, analysis TEXT, params TEXT, started REAL)''')
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                run_id INTEGER, image TEXT, class TEXT, measure TEXT, value REAL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS results_by_measure ON results (run_id, measure, class)')
+        self.runs = {}
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # run_id for an analysis and parameter set, one new run per distinct set within this store
+    def run_id(self, analysis, params):
+        key = (analysis, json.dumps(params, sort_keys=True))
+        if key not in self.runs:
+            with self.connection as db:
+                cursor = db.execute('INSERT INTO runs (analysis, params, started) VALUES (?, ?, ?)',
+                                    (*key, time.time()))
+            self.runs[key] = cursor.lastrowid
+        return self.runs[key]
+
+    # buffers every numeric value of a record, writing them once enough rows have gathered.
+    def add(self, record):
+        run_id = self.run_id(record['analysis'], record.get('params', {}))
+        for row in record['rows']:
+            for measure, value in row.items():
+                if measure != 'class':
+                    self.buffer.append((run_id, record['image'], row['class'], measure, float(value)))
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with self.connection as db:
+                db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?)', self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def query(self, sql, args=()):
+        self.flush()
+        return self.connection.execute(sql, args).fetchall()
+
+    def list_runs(self):
+        return self.query('''SELECT run_id, analysis, params, started, COUNT(DISTINCT image)
+                             FROM runs LEFT JOIN results USING (run_id) GROUP BY run_id ORDER BY run_id''')
+
+    """
+    Writes results as a CSV with one row per run and image, and one column per class and measure.
+    Only results of analysis if given. Returns the number of rows written.
+    """
+    def export_csv(self, output_path, analysis=None):
+        query = 'SELECT run_id, analysis, image, class, measure, value FROM results JOIN runs USING (run_id)'
+        args = ()
+        if analysis:
+            query += ' WHERE analysis = ?'
+            args = (analysis,)
+        rows, columns = {}, {}
+        for run_id, run_analysis, image, cls, measure, value in self.query(query + ' ORDER BY results.rowid', args):
+            rows.setdefault((run_id, run_analysis, image), {})[f'{cls} {measure}'] = value
+            columns.setdefault(f'{cls} {measure}', None)
+
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Run', 'Analysis', 'Image', *columns])
+            for (run_id, run_analysis, image), values in rows.items():
+                writer.writerow([run_id, run_analysis, image, *(values.get(column, '') for column in columns)])
+        return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or export the batch results database.')
+    parser.add_argument('--path', default=RESULTS_PATH, help='results database')
+    parser.add_argument('--runs', action='store_true', help='list the runs and their parameters')
+    parser.add_argument('--export', help='write the results to this CSV, one row per image')
+    parser.add_argument('--analysis', help='only export results of this analysis')
+    args = parser.parse_args(argv)
+
+    with ResultsStore(args.path) as store:
+        if args.export:
+            count = store.export_csv(args.export, args.analysis)
+            print(f'Exported {count} rows to {args.export}')
+        if args.runs or not args.export:
+            for run_id, analysis, params, started, images in store.list_runs():
+                print(f'{run_id}: {analysis}, {images} images, {time.strftime("%Y-%m-%d %H:%M", time.localtime(started))}, {params}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Approximate screening of many slides against a cutoff, e.g. which of 10,000 slides are above 5% red or
+lipid coverage, without analysing every slide at full resolution.
+
+Each image is analysed on a sample of about SAMPLE_PIXELS pixels: every n-th pixel of every n-th row of
+memory-mapped arrays, or a reduced-resolution decode (JPEG draft scaling, the smallest fitting page of a
+pyramid TIFF) thinned out the same way for other files. The sample gives an estimated percentage with a
+confidence interval, from how much the percentage varies between REPLICATES x REPLICATES interleaved
+sub-samples (each taking every REPLICATES-th sampled pixel, at a different offset). Only images whose
+interval contains the cutoff are analysed again at full resolution, so images are flagged on the right
+side of the cutoff while most of them never get a full-resolution pass.
+
+The interval only covers sampling error, so every estimate it is used for has to be made from
+full-resolution pixels or corrected for what it cannot see:
+- Nuclei masks are cleaned up with morphology, which depends on neighbouring pixels. They are estimated
+  from BLOCK_SIZE x BLOCK_SIZE blocks of full-resolution pixels of memory-mapped arrays (each cleaned up
+  with the same border as a tiled run, so they match the whole-image masks exactly, with the blocks as
+  the interleaved sub-samples). Other files would have to be decoded in full, so their nuclei are always
+  analysed at full resolution.
+- Reduced decodes average neighbouring pixels before thresholding, which can shift the percentage
+  either way by an amount that depends on the slides. calibrate_margin measures it on the first
+  CALIBRATION_IMAGES reduced-decode images of a run, analysed both ways, and widens the intervals of
+  reduced decodes by the resulting margin. Without a margin they are always analysed at full resolution.
+
+The speed-up depends on the file format: memory-mapped arrays and pyramid TIFFs only read the sampled
+pixels, JPEGs still have to be entropy decoded in full (a few times faster), and PNGs and flat TIFFs are
+decoded in full, so only the analysis itself gets cheaper.
+"""
+
+import math
+
+import numpy as np
+from PIL import Image
+
+import ImageLoader
+import Preview
+import Profiling
+import RelativeRed
+import UpdatedCodeLipidNuclei
+
+SAMPLE_PIXELS = 250_000   # pixels analysed per image
+REPLICATES = 3            # the sample is split into REPLICATES x REPLICATES interleaved sub-samples
+T_VALUE = 2.306           # interval half-width in standard errors: 95% for the 8 degrees of freedom of 3 x 3 replicates
+BLOCK_SIZE = 32           # edge of the full-resolution blocks nuclei are estimated from
+CALIBRATION_IMAGES = 10   # reduced-decode images analysed both ways to calibrate the margin
+
+# two-sided 95% t values by degrees of freedom, for the prediction bound of calibrate_margin
+T_VALUES = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262}
+
+
+# distance between sampled pixels (in both directions) that leaves at most max_pixels of a width x height image
+def sample_step(width, height, max_pixels=SAMPLE_PIXELS):
+    return max(1, math.ceil(math.sqrt(width * height / max(max_pixels, 1))))
+
+
+# opens an image switched to the reduced decode sample_rgb uses. Returns (img, full-resolution size).
+def open_reduced(image_path, max_pixels=SAMPLE_PIXELS):
+    img = Image.open(image_path)
+    full_size = img.size
+    step = sample_step(*full_size, max_pixels)
+    Preview.reduce_decode(img, (max(1, full_size[0] // step), max(1, full_size[1] // step)))
+    return img, full_size
+
+
+# whether sample_rgb would take an image's sample from a reduced decode, from its header alone
+def is_reduced(image_path, max_pixels=SAMPLE_PIXELS):
+    if ImageLoader.is_array_file(image_path):
+        return False
+    img, full_size = open_reduced(image_path, max_pixels)
+    with img:
+        return img.size[0] != full_size[0]
+
+
+"""
+An RGB sample of about max_pixels pixels spread evenly over the image, without decoding it at full size
+where possible. Returns (sample, reduced), reduced being True when the pixels come from a reduced decode
+rather than being pixels of the full-resolution image.
+"""
+def sample_rgb(image_path, max_pixels=SAMPLE_PIXELS):
+    if ImageLoader.is_array_file(image_path):
+        rgb = ImageLoader.load_array(image_path)
+        if rgb.ndim == 4:
+            raise ValueError(f'{image_path} is a stack, screen its frames one at a time')
+        step = sample_step(rgb.shape[1], rgb.shape[0], max_pixels)
+        return np.ascontiguousarray(rgb[::step, ::step]), False  # only the sampled rows are read from disk
+
+    img, full_size = open_reduced(image_path, max_pixels)
+    with img:
+        with Profiling.stage('decode'):
+            rgb = np.asarray(img.convert('RGB'))
+    step = sample_step(rgb.shape[1], rgb.shape[0], max_pixels)
+    return rgb[::step, ::step], rgb.shape[1] != full_size[0]
+
+
+"""
+Nuclei mask of about max_pixels full-resolution pixels of a BGR array (e.g. a memory map), made of
+block x block blocks spread evenly over the image. Each block is read with the halo of a tiled run
+(UpdatedCodeLipidNuclei.TILE_HALO), so its clean-up sees the same neighbours as a whole-image run.
+Returns (mosaic of the blocks' masks, (block height, block width)).
+"""
+def sample_nuclei_blocks(image, settings, max_pixels=SAMPLE_PIXELS, block=BLOCK_SIZE):
+    h, w = image.shape[:2]
+    block_h, block_w = min(block, h), min(block, w)
+    spacing = max(block, sample_step(w, h, max(1, max_pixels // (block * block))))
+    # one block centred in each cell of spacing x spacing pixels
+    ys = range(min((spacing - block_h) // 2, h - block_h), h - block_h + 1, spacing)
+    xs = range(min((spacing - block_w) // 2, w - block_w), w - block_w + 1, spacing)
+    halo = UpdatedCodeLipidNuclei.TILE_HALO
+
+    mosaic = np.empty((len(ys) * block_h, len(xs) * block_w), dtype=np.uint8)
+    with Profiling.stage('nuclei_blocks'):
+        for row, y in enumerate(ys):
+            for column, x in enumerate(xs):
+                y0, x0 = max(0, y - halo), max(0, x - halo)
+                y1, x1 = min(h, y + block_h + halo), min(w, x + block_w + halo)
+                tile = np.ascontiguousarray(image[y0:y1, x0:x1])
+                nuclei = UpdatedCodeLipidNuclei.build_masks(tile, **settings)['Nuclei']
+                mosaic[row * block_h:(row + 1) * block_h, column * block_w:(column + 1) * block_w] = \
+                    nuclei[y - y0:y - y0 + block_h, x - x0:x - x0 + block_w]
+    return mosaic, (block_h, block_w)
+
+
+"""
+Estimated percentage of set pixels in a sample mask, with a confidence interval. The standard error is
+the larger of the one measured between the interleaved sub-samples and the one for independently drawn
+pixels. With block, the mask is a mosaic of sampled blocks of that (height, width) and whole blocks are
+interleaved instead of pixels. Returns (estimate, low, high) in percent.
+"""
+def estimate_percent(mask, replicates=REPLICATES, t_value=T_VALUE, block=(1, 1)):
+    fraction = np.count_nonzero(mask) / mask.size if mask.size else 0.0
+    error = math.sqrt(fraction * (1 - fraction) / max(mask.size, 1))
+
+    block_h, block_w = block
+    rows, columns = mask.shape[0] // block_h, mask.shape[1] // block_w
+    counts = np.count_nonzero(mask[:rows * block_h, :columns * block_w].reshape(rows, block_h, columns, block_w),
+                              axis=(1, 3))
+    parts = [counts[y::replicates, x::replicates] for y in range(replicates) for x in range(replicates)]
+    parts = [part.sum() / (part.size * block_h * block_w) for part in parts if part.size]
+    if len(parts) > 1:
+        error = max(error, float(np.std(parts, ddof=1)) / math.sqrt(len(parts)))
+    return fraction * 100, max(0.0, (fraction - t_value * error) * 100), min(100.0, (fraction + t_value * error) * 100)
+
+
+"""
+Screening record for ResultsStore: the estimate and interval, or the full-resolution percentage from
+full() when the cutoff is within the interval. Intervals of reduced decodes are widened by margin, and
+with no margin (or no estimate at all, estimate None) the image is always analysed at full resolution.
+'flagged' is 1 for images at or above the cutoff.
+"""
+def screen_record(image_path, analysis, cls, estimate, low, high, reduced, cutoff, margin, full, params):
+    if estimate is None or (reduced and margin is None):
+        escalated = True
+    else:
+        widen = margin if reduced else 0.0
+        escalated = low - widen <= cutoff <= high + widen
+    if escalated:
+        with Profiling.stage('full_resolution'):
+            estimate = low = high = full()
+    row = {'class': cls, 'percent': estimate, 'ci_low': low, 'ci_high': high,
+           'escalated': int(escalated), 'flagged': int(estimate >= cutoff)}
+    params = {**params, 'cutoff': cutoff, 'margin': margin}
+    return {'analysis': f'{analysis}_screen', 'image': image_path, 'params': params, 'rows': [row]}
+
+
+# estimated whole-image red percentage (pixels above red_threshold): (estimate, low, high, reduced)
+def estimate_red(image_path, red_threshold=30, max_pixels=SAMPLE_PIXELS):
+    sample, reduced = sample_rgb(image_path, max_pixels)
+    with Profiling.stage('redscale'):
+        mask = RelativeRed.redscale_array(sample) > red_threshold
+    return (*estimate_percent(mask), reduced)
+
+
+def full_red(image_path, red_threshold=30):
+    whole, _ = RelativeRed.red_percentages(ImageLoader.load_rgb(image_path), [], red_threshold)
+    return whole
+
+
+# screens the whole-image red percentage (pixels above red_threshold) against cutoff. full_percent is the
+# full-resolution percentage if it is already known (e.g. from calibrate_margin), which is then used as is.
+def screen_red(image_path, red_threshold=30, cutoff=5.0, max_pixels=SAMPLE_PIXELS, margin=None, full_percent=None):
+    if full_percent is None:
+        estimate, low, high, reduced = estimate_red(image_path, red_threshold, max_pixels)
+        full = lambda: full_red(image_path, red_threshold)
+    else:
+        estimate, low, high, reduced, full = None, None, None, False, lambda: full_percent
+    params = {'red_threshold': red_threshold, 'sample_pixels': max_pixels}
+    return screen_record(image_path, 'relative_red', 'Whole image', estimate, low, high, reduced, cutoff, margin,
+                         full, params)
+
+
+"""
+Estimated percentage of one lipid/nuclei class ('Lipids' or 'Nuclei') with a loaded profile:
+(estimate, low, high, reduced). Nuclei of files other than arrays cannot be estimated from
+full-resolution pixels without decoding them in full, so they get (None, None, None, False).
+"""
+def estimate_lipid_nuclei(image_path, profile, cls='Lipids', max_pixels=SAMPLE_PIXELS):
+    settings = UpdatedCodeLipidNuclei.mask_settings(profile)
+    if cls == 'Nuclei':
+        if not ImageLoader.is_array_file(image_path):
+            return None, None, None, False
+        image = UpdatedCodeLipidNuclei.imread(image_path)
+        if image.ndim == 4:
+            raise ValueError(f'{image_path} is a stack, screen its frames one at a time')
+        mask, block = sample_nuclei_blocks(image, settings, max_pixels)
+        return (*estimate_percent(mask, block=block), False)
+
+    sample, reduced = sample_rgb(image_path, max_pixels)
+    sample = np.ascontiguousarray(sample[..., ::-1])  # BGR, like cv2.imread
+    # the lipid mask is classified pixel by pixel, so sampled pixels give exactly the full image's mask there
+    mask = UpdatedCodeLipidNuclei.build_masks(sample, **settings)[cls]
+    return (*estimate_percent(mask), reduced)
+
+
+def full_lipid_nuclei(image_path, profile, cls='Lipids'):
+    image = UpdatedCodeLipidNuclei.imread(image_path)
+    if image is None:
+        raise ValueError(f'Could not read the image {image_path}.')
+    results, _ = UpdatedCodeLipidNuclei.analyze_array(image, profile)
+    return next(row['Percent of total (%)'] for row in results if row['Class'] == cls)
+
+
+# screens the percentage of one lipid/nuclei class ('Lipids' or 'Nuclei') with a calibration profile against
+# cutoff. full_percent is used as is, like in screen_red.
+def screen_lipid_nuclei(image_path, profile_path, cutoff=5.0, cls='Lipids', max_pixels=SAMPLE_PIXELS, margin=None,
+                        full_percent=None):
+    profile = UpdatedCodeLipidNuclei.load_profile(profile_path)
+    if full_percent is None:
+        estimate, low, high, reduced = estimate_lipid_nuclei(image_path, profile, cls, max_pixels)
+        full = lambda: full_lipid_nuclei(image_path, profile, cls)
+    else:
+        estimate, low, high, reduced, full = None, None, None, False, lambda: full_percent
+    params = {**UpdatedCodeLipidNuclei.mask_settings(profile), 'hsv_bounds': profile['hsv_bounds'],
+              'sample_pixels': max_pixels}
+    return screen_record(image_path, 'lipid_nuclei', cls, estimate, low, high, reduced, cutoff, margin,
+                         full, params)
+
+
+"""
+Margin for the intervals of reduced decodes, calibrated on the slides being screened: the first count
+images of image_paths that would be sampled from a reduced decode are estimated (estimate(image_path)
+returning (estimate, low, high, reduced)) and analysed at full resolution (full(image_path)). The
+margin is the 95% prediction bound of the difference for one more image, |mean| + t * sd * sqrt(1 + 1/n),
+so it follows the bias and spread seen on these slides rather than a fixed guess. Returns (margin,
+{image_path: full-resolution percentage} of the images used, to be screened with full_percent rather
+than analysed again); margin is None (always analyse reduced decodes at full resolution) when fewer
+than two reduced-decode images were found, and 0.0 when there was none at all.
+"""
+def calibrate_margin(image_paths, estimate, full, max_pixels=SAMPLE_PIXELS, count=CALIBRATION_IMAGES):
+    differences = []
+    fulls = {}
+    reduced_images = 0
+    for image_path in image_paths:
+        if len(fulls) == count:
+            break
+        try:
+            if not is_reduced(image_path, max_pixels):
+                continue
+            reduced_images += 1
+            fulls[image_path] = full(image_path)
+            differences.append(fulls[image_path] - estimate(image_path)[0])
+        except Exception as e:
+            print(f'Error: {image_path} could not be used for calibration ({type(e).__name__}: {e})')
+
+    if len(differences) < 2:
+        return (0.0 if reduced_images == 0 else None), fulls
+    n = len(differences)
+    mean = sum(differences) / n
+    spread = math.sqrt(sum((d - mean) ** 2 for d in differences) / (n - 1))
+    return abs(mean) + T_VALUES[min(n - 1, 9)] * spread * math.sqrt(1 + 1 / n), fulls  # t of 9 is on the safe side beyond
+
+
+def format_screen_record(record):
+    row = record['rows'][0]
+    side = 'at or above' if row['flagged'] else 'below'
+    name = record['image'].split('/')[-1].split('\\')[-1]
+    if row['escalated']:
+        how = 'checked at full resolution'
+    else:
+        how = f"estimated, {row['ci_low']:.2f}-{row['ci_high']:.2f}%"
+    return f"{name}: {row['class']} {row['percent']:.2f}% ({how}), {side} the {record['params']['cutoff']:g}% cutoff."
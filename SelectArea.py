@@ -1,7 +1,9 @@
 import os
+import json
 import tkinter as tk
 from tkinter import filedialog
-from PIL import Image, ImageTk, ImageDraw
+from PIL import ImageTk, ImageDraw
+import Preview
 
 
 """
@@ -44,7 +46,8 @@ class ImageCoordinateSelector:
         else:
             file_path = self.image_path
         if file_path:
-            self.image = Image.open(file_path)
+            # only the header is read here, the pixels come from a reduced-resolution preview
+            self.image_size = Preview.image_size(file_path)
             self.render_image()
 
     def render_image(self):
@@ -53,7 +56,7 @@ class ImageCoordinateSelector:
         screen_height = self.root.winfo_screenheight()
 
         # Get the original image dimensions
-        original_width, original_height = self.image.size
+        original_width, original_height = self.image_size
 
         # Calculate the resizing ratio
         width_ratio = (screen_width / original_width) * 0.75
@@ -65,8 +68,8 @@ class ImageCoordinateSelector:
         new_height = int(original_height * self.resize_ratio)
         size = (new_width, new_height)
 
-        # Resize the image
-        self.image = self.image.resize(size)
+        # Load the image at display size, clicks map back to full resolution through resize_ratio
+        self.image = Preview.load_preview(self.image_path, size)
         self.tk_image = ImageTk.PhotoImage(self.image)
 
         # Set canvas dimensions to match the resized image
@@ -98,6 +101,10 @@ class ImageCoordinateSelector:
 
     def on_close(self):
         self.save_canvas_as_image()
+        coords = [list(coord) for coord in self.all_coords]
+        for coord in coords:
+            order_coords(coord)
+        save_areas(self.image_path, coords)
         self.root.destroy()
 
     def save_canvas_as_image(self):
@@ -131,6 +138,37 @@ def order_coords(coords):
         coords[1], coords[3] = coords[3], coords[1]
 
 
+# path of the JSON sidecar that stores the selected areas for an image, next to the saved canvas image.
+def areas_path(image_path, output_dir='SelectedAreaImages'):
+    image_name = image_path.split("/")[-1].split("\\")[-1]
+    return os.path.join(output_dir, f"{image_name}_selected_areas.json")
+
+
+# writes the selected areas of an image to its JSON sidecar so they can be reused without the window.
+def save_areas(image_path, coords, output_dir='SelectedAreaImages'):
+    os.makedirs(output_dir, exist_ok=True)  # Creates selected areas directory if it doesn't exist
+    output_file = areas_path(image_path, output_dir)
+    with open(output_file, 'w') as f:
+        json.dump({'image': image_path.split("/")[-1].split("\\")[-1], 'areas': coords}, f)
+    print(f"Selected areas saved as {output_file}")
+
+
+"""
+Reads selected areas from a JSON sidecar. roi_path can be a sidecar file, or a directory
+holding sidecars saved by earlier sessions, in which case the one for image_path is used.
+"""
+def load_areas(roi_path, image_path=None):
+    if os.path.isdir(roi_path):
+        roi_path = areas_path(image_path, roi_path)
+    with open(roi_path) as f:
+        data = json.load(f)
+    coords = data['areas'] if isinstance(data, dict) else data
+    coords = [[int(round(v)) for v in coord[:4]] for coord in coords]
+    for coord in coords:
+        order_coords(coord)
+    return coords
+
+
 """
 Allows the user to select multiple areas, then returns the coordinates 
 for the corners of those areas in a 2D list.
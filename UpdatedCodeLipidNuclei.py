@@ -10,7 +10,17 @@ import cv2
 import numpy as np
 import os
 import csv
-import easygui  # pip install easygui
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import ImageLoader
+import ImageStandardizer
+import ObjectMeasurements
+import Preview
+import Profiling
+import ResultCache
 
 # =========================
 # Settings
@@ -24,6 +34,7 @@ CROSSHAIR_ARM = 10     # pixels
 CROSSHAIR_THK = 3      # thickness
 MAX_DISPLAY_W = 1400   # maximum window width for preview
 MAX_DISPLAY_H = 900    # maximum window height for preview
+KEY_WAIT_MS = 50       # how long the selection window waits for a key before checking again
 
 # HSV padding around min/max from selected points (tune if needed)
 HSV_PAD = np.array([10, 50, 50], dtype=np.int32)  # (H, S, V) margins
@@ -32,292 +43,535 @@ HSV_PAD = np.array([10, 50, 50], dtype=np.int32)  # (H, S, V) margins
 NUCLEI_ERODE_RADIUS_PX = 1   # 0 disables erosion; try 1–2 if halos persist
 NUCLEI_ERODE_ITER = 1
 
+# Channel ratio thresholds (tune as needed)
+LIPID_THRESH = 1.5
+NUCLEI_THRESH = 1.5
+NUCLEI_MIN_BLUE = 80   # nuclei must also have B above this intensity
+
+# Pixels classified per chunk by the lookup table (bounds temporary index arrays)
+CLASSIFY_CHUNK_PIXELS = 1 << 20
+
+# Morphological cleanup on nuclei (open then close)
+CLEANUP_RADIUS_PX = 1
+
 # Area conversion (µm per pixel). Set to your microscope calibration.
 MICRONS_PER_PIXEL = 0.5
 
+# Tiled processing for slides too large to hold every intermediate array in memory
+TILE_SIZE = 2048       # tile edge in pixels (without halo)
+# Open and close each erode and dilate once, so a mask pixel depends on pixels up to
+# 4 * CLEANUP_RADIUS_PX away. Tiles read that much extra border so seams match a whole-image run.
+TILE_HALO = 4 * CLEANUP_RADIUS_PX
+
+# Label map values: one bit per class, so a pixel in both classes is LABEL_OVERLAP
+LABEL_NONE = 0
+LABEL_LIPID = 1
+LABEL_NUCLEI = 2
+LABEL_OVERLAP = LABEL_LIPID | LABEL_NUCLEI
+
+# Overlay colour of each label (BGR): none, lipids green, nuclei orange, overlap purple
+OVERLAY_PALETTE = np.array([(0, 0, 0), (0, 255, 0), (0, 165, 255), (255, 0, 255)], dtype=np.uint8)
+OVERLAY_LUT = np.zeros((256, 1, 3), dtype=np.uint8)
+OVERLAY_LUT[:len(OVERLAY_PALETTE), 0] = OVERLAY_PALETTE
+
+
 # =========================
 # File chooser
 # =========================
-file_path = easygui.fileopenbox(title="Select an image",
-                                filetypes=["*.jpg","*.jpeg","*.png","*.tif","*.tiff","*.bmp"])
-if not file_path:
-    raise SystemExit("No file selected.")
+def choose_file():
+    """Ask the user for an image with a file dialog."""
+    import easygui  # pip install easygui
 
-image = cv2.imread(file_path)
-if image is None:
-    raise SystemExit("Could not read the image.")
+    file_path = easygui.fileopenbox(title="Select an image",
+                                    filetypes=["*.jpg","*.jpeg","*.png","*.tif","*.tiff","*.bmp","*.npy","*.raw"])
+    if not file_path:
+        raise SystemExit("No file selected.")
+    return file_path
 
-h, w = image.shape[:2]
 
-# =========================
-# Build a fixed-size display image (scaled copy) and map clicks back
-# =========================
-scale = min(MAX_DISPLAY_W / w, MAX_DISPLAY_H / h, 1.0)
-disp_w, disp_h = int(round(w * scale)), int(round(h * scale))
-disp_base = cv2.resize(image, (disp_w, disp_h), interpolation=cv2.INTER_AREA).copy()
-disp_work = disp_base.copy()
-
-def to_orig_coords(x_disp, y_disp):
-    """Map display coords back to original image coords."""
-    x = int(round(x_disp / scale))
-    y = int(round(y_disp / scale))
-    x = max(0, min(w - 1, x))
-    y = max(0, min(h - 1, y))
-    return x, y
-
-def to_disp_coords(x_orig, y_orig):
-    """Map original coords to display coords (for redraw)."""
-    xd = int(round(x_orig * scale))
-    yd = int(round(y_orig * scale))
-    xd = max(0, min(disp_w - 1, xd))
-    yd = max(0, min(disp_h - 1, yd))
-    return xd, yd
+def imread(file_path):
+    """cv2.imread, but .npy/raw array files are memory mapped as a BGR view instead of decoded."""
+    if ImageLoader.is_array_file(file_path):
+        return ImageLoader.load_array(file_path, "BGR")
+    return cv2.imread(file_path)
+
+
+def open_tiled(file_path):
+    """
+    The image of a tiled run. Only memory-mapped .npy/raw array files are accepted: their tiles are read
+    from disk as they are needed, whereas other formats would be decoded whole before the first tile.
+    """
+    if not ImageLoader.is_array_file(file_path):
+        raise ValueError(f"Tiled runs need a .npy or raw array file, {os.path.basename(file_path)} would be "
+                         "decoded whole into memory.")
+    return imread(file_path)
+
+
+def read_image(file_path):
+    """Load a BGR image, exiting if it cannot be read."""
+    image = imread(file_path)
+    if image is None:
+        raise SystemExit("Could not read the image.")
+    return image
+
 
 def draw_crosshair(img, x, y, color_bgr):
     """Draw a thick crosshair centered at (x, y) on the DISPLAY image."""
     cv2.line(img, (x - CROSSHAIR_ARM, y), (x + CROSSHAIR_ARM, y), color_bgr, CROSSHAIR_THK)
     cv2.line(img, (x, y - CROSSHAIR_ARM), (x, y + CROSSHAIR_ARM), color_bgr, CROSSHAIR_THK)
 
-def redraw_all_crosshairs():
-    """Redraw all accepted crosshairs and the pending one onto disp_work."""
-    global disp_work
-    disp_work = disp_base.copy()
-    # Accepted points
-    for cls_name, color in CLASSES:
-        for (xo, yo) in accepted_points[cls_name]:
-            xd, yd = to_disp_coords(xo, yo)
-            draw_crosshair(disp_work, xd, yd, color)
-    # Pending point (not yet accepted)
-    if pending_point is not None:
-        xd, yd = pending_point['disp']
-        draw_crosshair(disp_work, xd, yd, pending_point['color'])
-
-# =========================
-# Selection state
-# =========================
-accepted_points = {cls: [] for cls, _ in CLASSES}   # original coords per class
-hsv_samples = {cls: [] for cls, _ in CLASSES}       # HSV samples per class
-current_class_idx = 0
-awaiting_decision = False
-pending_point = None  # {'orig':(x,y), 'disp':(xd,yd), 'color':(b,g,r)}
 
-# Precompute HSV for original image
-hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+def pixel_hsv(image, x, y):
+    """HSV of a single pixel, identical to indexing a converted full image."""
+    return cv2.cvtColor(image[y:y + 1, x:x + 1], cv2.COLOR_BGR2HSV)[0, 0]
 
-# =========================
-# Mouse callback
-# =========================
-def mouse_cb(event, x, y, flags, param):
-    global pending_point, awaiting_decision
-    if event == cv2.EVENT_LBUTTONDOWN and not awaiting_decision:
-        # Convert display coords to original coords
-        xo, yo = to_orig_coords(x, y)
-        cls_name, color = CLASSES[current_class_idx]
-
-        # Prepare a pending point
-        pending_point = {
-            'orig': (xo, yo),
-            'disp': (x, y),
-            'color': color,
-            'class': cls_name
-        }
-        awaiting_decision = True
-        redraw_all_crosshairs()
-        cv2.imshow("Select Points", disp_work)
-        print(f"Candidate selected at ({xo}, {yo}) for {cls_name}. Press 'a' to accept or 'r' to redo.")
 
 # =========================
-# Selection loop
+# Point selection window
 # =========================
-cv2.namedWindow("Select Points", cv2.WINDOW_NORMAL)
-cv2.resizeWindow("Select Points", disp_w, disp_h)
-cv2.setMouseCallback("Select Points", mouse_cb)
-
-print("Selection order:")
-for cls_name, _ in CLASSES:
-    print(f" - {cls_name}: pick {POINTS_PER_CLASS} points")
-print("Controls: Left click to choose a point → 'a' accept, 'r' redo, 'u' undo last accepted, 'n' next class, ESC to quit.")
-
-while current_class_idx < len(CLASSES):
-    cls_name, color = CLASSES[current_class_idx]
-
-    # Show and wait for keys
-    cv2.imshow("Select Points", disp_work)
-    key = cv2.waitKey(10) & 0xFF
-
-    # Accept/redo pending
-    if awaiting_decision:
-        if key in (ord('a'), 13, 32):  # 'a' or Enter or Space
-            # Commit the pending point
-            (xo, yo) = pending_point['orig']
-            accepted_points[cls_name].append((xo, yo))
-            hsv_samples[cls_name].append(hsv_image[yo, xo])
-            awaiting_decision = False
-            print(f"Point {len(accepted_points[cls_name])} of {POINTS_PER_CLASS} selected for {cls_name}")
-            pending_point = None
-            redraw_all_crosshairs()
-        elif key in (ord('r'), 8, 127):  # 'r' or Backspace/Delete
-            # Discard the pending point
-            awaiting_decision = False
-            pending_point = None
-            redraw_all_crosshairs()
+class PointSelector:
+    """
+    Lets the user pick POINTS_PER_CLASS sample points for each class on a scaled copy
+    of the image, mapping clicks back to original image coordinates. With file_path the
+    scaled copy comes from the preview cache instead of resizing the full image, unless
+    the file has more than 8 bits per sample (see Preview.same_as_cv2).
+
+    The masks the analysis will produce are previewed live on the scaled copy ('m' toggles
+    them), with trackbars for the channel ratio thresholds; the chosen thresholds are kept in
+    mask_settings. Only the parts of the window that change are redrawn.
+    """
+    def __init__(self, image, file_path=None):
+        self.image = image
+        self.h, self.w = image.shape[:2]
+
+        # Build a fixed-size display image (scaled copy) and map clicks back
+        self.scale = min(MAX_DISPLAY_W / self.w, MAX_DISPLAY_H / self.h, 1.0)
+        self.disp_w, self.disp_h = int(round(self.w * self.scale)), int(round(self.h * self.scale))
+        # cv2.imread orients the image by its EXIF tag and scales 16-bit images, so the preview has to match
+        if file_path is not None and Preview.same_as_cv2(file_path):
+            preview = Preview.load_preview(file_path, (self.disp_w, self.disp_h), oriented=True)
+            self.disp_base = cv2.cvtColor(np.asarray(preview), cv2.COLOR_RGB2BGR)
+        else:
+            self.disp_base = cv2.resize(image, (self.disp_w, self.disp_h), interpolation=cv2.INTER_AREA).copy()
+
+        # Live mask preview: the background is the display image, or its mask overlay
+        self.mask_settings = {"lipid_thresh": LIPID_THRESH, "nuclei_thresh": NUCLEI_THRESH,
+                              "nuclei_min_blue": NUCLEI_MIN_BLUE}
+        self.show_masks = True
+        self.background = self.disp_base
+        self.disp_work = self.disp_base.copy()
+        self.dirty = True  # disp_work changed since it was last shown
+
+        # Selection state
+        self.accepted_points = {cls: [] for cls, _ in CLASSES}   # original coords per class
+        self.hsv_samples = {cls: [] for cls, _ in CLASSES}       # HSV samples per class
+        self.current_class_idx = 0
+        self.awaiting_decision = False
+        self.pending_point = None  # {'orig':(x,y), 'disp':(xd,yd), 'color':(b,g,r)}
+
+    def to_orig_coords(self, x_disp, y_disp):
+        """Map display coords back to original image coords."""
+        x = int(round(x_disp / self.scale))
+        y = int(round(y_disp / self.scale))
+        x = max(0, min(self.w - 1, x))
+        y = max(0, min(self.h - 1, y))
+        return x, y
+
+    def to_disp_coords(self, x_orig, y_orig):
+        """Map original coords to display coords (for redraw)."""
+        xd = int(round(x_orig * self.scale))
+        yd = int(round(y_orig * self.scale))
+        xd = max(0, min(self.disp_w - 1, xd))
+        yd = max(0, min(self.disp_h - 1, yd))
+        return xd, yd
+
+    def crosshairs(self):
+        """(display x, display y, colour) of every accepted crosshair and the pending one."""
+        marks = [(*self.to_disp_coords(xo, yo), color)
+                 for cls_name, color in CLASSES for (xo, yo) in self.accepted_points[cls_name]]
+        if self.pending_point is not None:
+            marks.append((*self.pending_point['disp'], self.pending_point['color']))
+        return marks
+
+    def update_background(self):
+        """Recompute the preview masks on the display image with the current thresholds."""
+        if self.show_masks:
+            labels = label_map(build_masks(self.disp_base, **self.mask_settings))
+            self.background = render_overlay(self.disp_base, labels)
+        else:
+            self.background = self.disp_base
+        self.redraw_all_crosshairs()
+
+    def redraw_all_crosshairs(self):
+        """Redraw all accepted crosshairs and the pending one onto a fresh copy of the background."""
+        np.copyto(self.disp_work, self.background)
+        for xd, yd, color in self.crosshairs():
+            draw_crosshair(self.disp_work, xd, yd, color)
+        self.dirty = True
+
+    def redraw_around(self, xd, yd):
+        """Restore the background under the crosshair at (xd, yd) and redraw the crosshairs overlapping it."""
+        reach = CROSSHAIR_ARM + CROSSHAIR_THK
+        x0, y0 = max(0, xd - reach), max(0, yd - reach)
+        x1, y1 = min(self.disp_w, xd + reach + 1), min(self.disp_h, yd + reach + 1)
+        self.disp_work[y0:y1, x0:x1] = self.background[y0:y1, x0:x1]
+        for x, y, color in self.crosshairs():
+            if abs(x - xd) <= 2 * reach and abs(y - yd) <= 2 * reach:
+                draw_crosshair(self.disp_work, x, y, color)
+        self.dirty = True
+
+    def threshold_cb(self, name, scale):
+        """Trackbar callback factory: sets a mask setting (trackbar position / scale) and refreshes the preview."""
+        def callback(position):
+            value = position / scale if scale != 1 else position
+            if self.mask_settings[name] != value:
+                self.mask_settings[name] = value
+                self.update_background()
+        return callback
+
+    def mouse_cb(self, event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN and not self.awaiting_decision:
+            # Convert display coords to original coords
+            xo, yo = self.to_orig_coords(x, y)
+            cls_name, color = CLASSES[self.current_class_idx]
+
+            # Prepare a pending point
+            self.pending_point = {
+                'orig': (xo, yo),
+                'disp': (x, y),
+                'color': color,
+                'class': cls_name
+            }
+            self.awaiting_decision = True
+            draw_crosshair(self.disp_work, x, y, color)
+            self.dirty = True
+            print(f"Candidate selected at ({xo}, {yo}) for {cls_name}. Press 'a' to accept or 'r' to redo.")
+
+    def run(self):
+        """Run the selection loop, returning (accepted_points, hsv_samples)."""
+        cv2.namedWindow("Select Points", cv2.WINDOW_NORMAL)
+        cv2.resizeWindow("Select Points", self.disp_w, self.disp_h)
+        cv2.setMouseCallback("Select Points", self.mouse_cb)
+        # Ratio thresholds in tenths, the blue intensity as is
+        cv2.createTrackbar("Lipid ratio x10", "Select Points", int(round(self.mask_settings["lipid_thresh"] * 10)), 50,
+                           self.threshold_cb("lipid_thresh", 10))
+        cv2.createTrackbar("Nuclei ratio x10", "Select Points", int(round(self.mask_settings["nuclei_thresh"] * 10)), 50,
+                           self.threshold_cb("nuclei_thresh", 10))
+        cv2.createTrackbar("Nuclei min blue", "Select Points", int(self.mask_settings["nuclei_min_blue"]), 255,
+                           self.threshold_cb("nuclei_min_blue", 1))
+        self.update_background()
+
+        print("Selection order:")
+        for cls_name, _ in CLASSES:
+            print(f" - {cls_name}: pick {POINTS_PER_CLASS} points")
+        print("Controls: Left click to choose a point → 'a' accept, 'r' redo, 'u' undo last accepted, 'n' next class, "
+              "'m' show/hide the mask preview, ESC to quit. Sliders set the lipid/nuclei thresholds.")
+
+        while self.current_class_idx < len(CLASSES):
+            cls_name, color = CLASSES[self.current_class_idx]
+
+            # Show only when something changed, and wait for keys without spinning
+            if self.dirty:
+                cv2.imshow("Select Points", self.disp_work)
+                self.dirty = False
+            key = cv2.waitKey(KEY_WAIT_MS) & 0xFF
+            if key == 0xFF:
+                continue  # no key, mouse and trackbar events were handled inside waitKey
+
+            if key == ord('m'):
+                self.show_masks = not self.show_masks
+                self.update_background()
+
+            # Accept/redo pending
+            if self.awaiting_decision:
+                if key in (ord('a'), 13, 32):  # 'a' or Enter or Space
+                    # Commit the pending point, its crosshair is already drawn
+                    (xo, yo) = self.pending_point['orig']
+                    self.accepted_points[cls_name].append((xo, yo))
+                    self.hsv_samples[cls_name].append(pixel_hsv(self.image, xo, yo))
+                    self.awaiting_decision = False
+                    print(f"Point {len(self.accepted_points[cls_name])} of {POINTS_PER_CLASS} selected for {cls_name}")
+                    self.pending_point = None
+                elif key in (ord('r'), 8, 127):  # 'r' or Backspace/Delete
+                    # Discard the pending point
+                    xd, yd = self.pending_point['disp']
+                    self.awaiting_decision = False
+                    self.pending_point = None
+                    self.redraw_around(xd, yd)
 
-    else:
-        # Undo last accepted point for this class
-        if key == ord('u'):
-            if accepted_points[cls_name]:
-                (ux, uy) = accepted_points[cls_name].pop()
-                if hsv_samples[cls_name]:
-                    hsv_samples[cls_name].pop()
-                print(f"Undid last point ({ux},{uy}) for {cls_name}. Now {len(accepted_points[cls_name])}/{POINTS_PER_CLASS}.")
-                redraw_all_crosshairs()
-
-        # Move to next class when enough points are accepted
-        if key == ord('n'):
-            if len(accepted_points[cls_name]) == POINTS_PER_CLASS:
-                current_class_idx += 1
-                if current_class_idx < len(CLASSES):
-                    print(f"→ Next: {CLASSES[current_class_idx][0]} (pick {POINTS_PER_CLASS} points)")
-                redraw_all_crosshairs()
             else:
-                remaining = POINTS_PER_CLASS - len(accepted_points[cls_name])
-                print(f"You still need {remaining} point(s) for {cls_name} before moving on.")
+                # Undo last accepted point for this class
+                if key == ord('u'):
+                    if self.accepted_points[cls_name]:
+                        (ux, uy) = self.accepted_points[cls_name].pop()
+                        if self.hsv_samples[cls_name]:
+                            self.hsv_samples[cls_name].pop()
+                        print(f"Undid last point ({ux},{uy}) for {cls_name}. Now {len(self.accepted_points[cls_name])}/{POINTS_PER_CLASS}.")
+                        self.redraw_around(*self.to_disp_coords(ux, uy))
+
+                # Move to next class when enough points are accepted
+                if key == ord('n'):
+                    if len(self.accepted_points[cls_name]) == POINTS_PER_CLASS:
+                        self.current_class_idx += 1
+                        if self.current_class_idx < len(CLASSES):
+                            print(f"→ Next: {CLASSES[self.current_class_idx][0]} (pick {POINTS_PER_CLASS} points)")
+                    else:
+                        remaining = POINTS_PER_CLASS - len(self.accepted_points[cls_name])
+                        print(f"You still need {remaining} point(s) for {cls_name} before moving on.")
+
+            if key == 27:  # ESC
+                cv2.destroyAllWindows()
+                raise SystemExit("Cancelled by user.")
+
+        cv2.destroyWindow("Select Points")
+        return self.accepted_points, self.hsv_samples
 
-    if key == 27:  # ESC
-        cv2.destroyAllWindows()
-        raise SystemExit("Cancelled by user.")
-
-cv2.destroyWindow("Select Points")
 
 # =========================
 # Build HSV masks from selected samples
 # =========================
-masks = {}
-hsv_bounds = {}
-for cls_name, _ in CLASSES:
-    pts = np.array(hsv_samples[cls_name], dtype=np.int32)  # shape: (N, 3)
-    # Robust min/max with padding
-    low = np.clip(pts.min(axis=0) - HSV_PAD, 0, 255)
-    high = np.clip(pts.max(axis=0) + HSV_PAD, 0, 255)
-    mask = cv2.inRange(hsv_image, low.astype(np.uint8), high.astype(np.uint8))
-    masks[cls_name] = mask
-    hsv_bounds[cls_name] = (low.astype(int).tolist(), high.astype(int).tolist())
-
-# --- Post-processing to reduce halos: erode nuclei; lipid priority wins in overlaps
-lipid_mask = masks["Lipids"].copy()
-nuclei_mask = masks["Nuclei"].copy()
-
-if NUCLEI_ERODE_RADIUS_PX > 0 and NUCLEI_ERODE_ITER > 0:
-    ksz = 2 * NUCLEI_ERODE_RADIUS_PX + 1
+def hsv_bounds_from_samples(hsv_samples):
+    """Robust min/max with padding of the HSV samples of each class."""
+    hsv_bounds = {}
+    for cls_name, _ in CLASSES:
+        pts = np.array(hsv_samples[cls_name], dtype=np.int32)  # shape: (N, 3)
+        low = np.clip(pts.min(axis=0) - HSV_PAD, 0, 255)
+        high = np.clip(pts.max(axis=0) + HSV_PAD, 0, 255)
+        hsv_bounds[cls_name] = (low.astype(int).tolist(), high.astype(int).tolist())
+    return hsv_bounds
+
+
+def build_hsv_masks(image, hsv_bounds):
+    """HSV range masks per class, with nuclei eroded to reduce halos."""
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    masks = {}
+    for cls_name, _ in CLASSES:
+        low, high = hsv_bounds[cls_name]
+        masks[cls_name] = cv2.inRange(hsv_image, np.array(low, dtype=np.uint8), np.array(high, dtype=np.uint8))
+    masks["Nuclei"] = erode_nuclei(masks["Nuclei"])
+    return masks
+
+
+def erode_nuclei(nuclei_mask):
+    """Erode the nuclei mask by NUCLEI_ERODE_RADIUS_PX to reduce halos."""
+    if NUCLEI_ERODE_RADIUS_PX > 0 and NUCLEI_ERODE_ITER > 0:
+        ksz = 2 * NUCLEI_ERODE_RADIUS_PX + 1
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksz, ksz))
+        nuclei_mask = cv2.erode(nuclei_mask, kernel, iterations=NUCLEI_ERODE_ITER)
+    return nuclei_mask
+
+
+# ===============================
+# CHANNEL OVERRIDE MASKS
+# ===============================
+@lru_cache(maxsize=16)
+def class_table(lipid_thresh=LIPID_THRESH, nuclei_thresh=NUCLEI_THRESH, nuclei_min_blue=NUCLEI_MIN_BLUE):
+    """
+    Lipid/nuclei membership for every (R, B) pair, as a flat 65536 entry table indexed by
+    R * 256 + B. Each little-endian uint16 entry holds the lipid mask value (0/255) in its
+    low byte and the nuclei mask value in its high byte.
+    """
+    # Same float64 arithmetic as a per-pixel evaluation, so the table matches it exactly
+    R = np.arange(256, dtype=float)[:, None]
+    B = np.arange(256, dtype=float)[None, :]
+
+    red_ratio = R / (B + 1e-5)
+    blue_ratio = B / (R + 1e-5)
+
+    # Lipid override: red dominance
+    lipid_override = (red_ratio > lipid_thresh) & (red_ratio > blue_ratio)
+    # Nuclei override: blue dominance with intensity filter
+    nuclei_override = (blue_ratio > nuclei_thresh) & (blue_ratio > red_ratio) & (B > nuclei_min_blue)
+
+    table = lipid_override * 0x00FF + nuclei_override * 0xFF00
+    table = table.astype("<u2").ravel()
+    table.flags.writeable = False
+    return table
+
+
+def classify_channels(image, lipid_thresh=LIPID_THRESH, nuclei_thresh=NUCLEI_THRESH, nuclei_min_blue=NUCLEI_MIN_BLUE):
+    """Lipid and nuclei masks (0/255) from red/blue channel dominance."""
+    table = class_table(lipid_thresh, nuclei_thresh, nuclei_min_blue)
+
+    # One gather per pixel, indexed by its (R, B) pair; G does not affect either class.
+    # Rows are gathered in chunks to keep the index temporaries small.
+    h, w = image.shape[:2]
+    classes = np.empty((h, w, 2), dtype=np.uint8)
+    classes_u2 = classes.view("<u2").reshape(h, w)
+    rows = max(1, CLASSIFY_CHUNK_PIXELS // max(w, 1))
+    for y in range(0, h, rows):
+        index = image[y:y + rows, :, 2].astype(np.uint16)
+        index <<= 8
+        index |= image[y:y + rows, :, 0]
+        np.take(table, index, out=classes_u2[y:y + rows])
+
+    # Both masks come out of the low/high bytes of each entry
+    lipid_mask, nuclei_mask = cv2.split(classes)
+    return lipid_mask, nuclei_mask
+
+
+def clean_nuclei_mask(nuclei_mask):
+    """Morphological open then close to remove specks and fill small gaps."""
+    ksz = 2 * CLEANUP_RADIUS_PX + 1
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksz, ksz))
-    nuclei_mask = cv2.erode(nuclei_mask, kernel, iterations=NUCLEI_ERODE_ITER)
+    nuclei_mask = cv2.morphologyEx(nuclei_mask, cv2.MORPH_OPEN, kernel)
+    nuclei_mask = cv2.morphologyEx(nuclei_mask, cv2.MORPH_CLOSE, kernel)
+    return nuclei_mask
+
+
+def build_masks(image, lipid_thresh=LIPID_THRESH, nuclei_thresh=NUCLEI_THRESH, nuclei_min_blue=NUCLEI_MIN_BLUE):
+    """Final {"Lipids", "Nuclei"} masks for a BGR image."""
+    with Profiling.stage("masks"):
+        lipid_mask, nuclei_mask = classify_channels(image, lipid_thresh, nuclei_thresh, nuclei_min_blue)
+    with Profiling.stage("morphology"):
+        nuclei_mask = clean_nuclei_mask(nuclei_mask)
+    return {
+        "Lipids": lipid_mask,
+        "Nuclei": nuclei_mask
+    }
+
 
 # ===============================
-# MASK RESET + CHANNEL OVERRIDE
+# TILED PROCESSING
 # ===============================
-# Reset masks fresh (prevents accumulation)
-lipid_mask = np.zeros((h, w), dtype=np.uint8)
-nuclei_mask = np.zeros((h, w), dtype=np.uint8)
-
-# Compute channel ratios
-R = image[:, :, 2].astype(float)
-G = image[:, :, 1].astype(float)
-B = image[:, :, 0].astype(float)
-
-red_ratio = R / (B + 1e-5)
-blue_ratio = B / (R + 1e-5)
-
-# Thresholds (tune as needed)
-lipid_thresh = 1.5
-nuclei_thresh = 1.5
-
-# Lipid override: red dominance
-lipid_override = (red_ratio > lipid_thresh) & (red_ratio > blue_ratio)
-lipid_mask[lipid_override] = 255
-
-# Nuclei override: blue dominance with intensity filter
-nuclei_override = (blue_ratio > nuclei_thresh) & (blue_ratio > red_ratio) & (B > 80)
-nuclei_mask[nuclei_override] = 255
-
-# Morphological cleanup on nuclei
-kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-nuclei_mask = cv2.morphologyEx(nuclei_mask, cv2.MORPH_OPEN, kernel)
-nuclei_mask = cv2.morphologyEx(nuclei_mask, cv2.MORPH_CLOSE, kernel)
-
-# Replace masks dict with refined versions
-masks = {
-    "Lipids": lipid_mask,
-    "Nuclei": nuclei_mask
-}
+def build_masks_tiled(image, labels_path=None, tile_size=TILE_SIZE, workers=None,
+                      lipid_thresh=LIPID_THRESH, nuclei_thresh=NUCLEI_THRESH, nuclei_min_blue=NUCLEI_MIN_BLUE):
+    """
+    Build the same masks as build_masks one tile at a time. With a memory-mapped image (see
+    open_tiled) peak memory depends on tile_size and workers rather than on the slide size; an
+    image already decoded into memory only saves the full-size masks. Tiles run in parallel threads (OpenCV releases
+    the GIL). If labels_path is given, the label map (see label_map) is written to a
+    memory-mapped .npy file of shape (h, w). Returns the pixel count per class.
+    """
+    h, w = image.shape[:2]
+    out = None
+    if labels_path is not None:
+        out = np.lib.format.open_memmap(labels_path, mode="w+", dtype=np.uint8, shape=(h, w))
+
+    def run_tile(y, x):
+        th, tw = min(tile_size, h - y), min(tile_size, w - x)
+        # Read the tile with a halo so morphology at the seams sees real neighbours
+        y0, x0 = max(0, y - TILE_HALO), max(0, x - TILE_HALO)
+        y1, x1 = min(h, y + th + TILE_HALO), min(w, x + tw + TILE_HALO)
+        tile_masks = build_masks(np.ascontiguousarray(image[y0:y1, x0:x1]), lipid_thresh, nuclei_thresh, nuclei_min_blue)
+
+        core = label_map(tile_masks)[y - y0:y - y0 + th, x - x0:x - x0 + tw]
+        if out is not None:
+            out[y:y + th, x:x + tw] = core
+        return label_counts(core)
+
+    tiles = [(y, x) for y in range(0, h, tile_size) for x in range(0, w, tile_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tile_counts = list(executor.map(lambda tile: run_tile(*tile), tiles))
+
+    if out is not None:
+        out.flush()
+    return {cls_name: sum(counts[cls_name] for counts in tile_counts) for cls_name, _ in CLASSES}
+
+
 # ===============================
-# VISUALIZE MASK OVERLAY (with purple for overlap)
+# LABEL MAP (none / lipid / nuclei / overlap)
 # ===============================
-overlay = image.copy()
+def label_map(masks):
+    """One uint8 label per pixel: LABEL_LIPID and LABEL_NUCLEI bits set, so both set is LABEL_OVERLAP."""
+    labels = np.bitwise_and(masks["Lipids"], LABEL_LIPID)
+    labels |= masks["Nuclei"] & LABEL_NUCLEI
+    return labels
+
+
+def label_counts(labels):
+    """Pixel count per class from one histogram of the label map (overlap pixels count for both)."""
+    counts = np.zeros(4, dtype=np.int64)
+    rows = max(1, CLASSIFY_CHUNK_PIXELS // max(labels.shape[1], 1))
+    for y in range(0, labels.shape[0], rows):
+        counts += np.bincount(labels[y:y + rows].ravel(), minlength=4)[:4]
+    return {
+        "Lipids": int(counts[LABEL_LIPID] + counts[LABEL_OVERLAP]),
+        "Nuclei": int(counts[LABEL_NUCLEI] + counts[LABEL_OVERLAP]),
+    }
+
+
+def save_labels(labels_path, labels):
+    """Save a label map as two bit-packed, compressed planes (about 1/4 bit per pixel before compression)."""
+    np.savez_compressed(
+        labels_path,
+        shape=np.array(labels.shape),
+        lipids=np.packbits(labels & LABEL_LIPID, axis=None),
+        nuclei=np.packbits(labels & LABEL_NUCLEI, axis=None),
+    )
+
+
+def load_labels(labels_path):
+    """Label map saved by save_labels."""
+    with np.load(labels_path) as data:
+        shape = tuple(data["shape"])
+        size = int(np.prod(shape))
+        labels = np.unpackbits(data["lipids"], count=size).reshape(shape)
+        labels |= np.unpackbits(data["nuclei"], count=size).reshape(shape) << 1
+    return labels
 
-# Start with a blank canvas
-color_mask = np.zeros_like(image)
 
-# Define colors (BGR format for OpenCV)
-green = (0, 255, 0)      # Lipids
-orange = (0, 165, 255)   # Nuclei
-purple = (255, 0, 255)   # Overlap (Lipids + Nuclei)
+# ===============================
+# VISUALIZE MASK OVERLAY (with purple for overlap)
+# ===============================
+def render_overlay(image, labels, max_size=None):
+    """
+    Blend class colours over the image, purple where lipids and nuclei overlap. With max_size
+    (width, height) the overlay is rendered at most that size, e.g. for a preview window.
+    """
+    h, w = labels.shape
+    if max_size is not None:
+        scale = min(1.0, max_size[0] / w, max_size[1] / h)
+        if scale < 1.0:
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            labels = cv2.resize(labels, size, interpolation=cv2.INTER_NEAREST)
 
-# Boolean masks
-lipid_only = (masks["Lipids"] > 0) & (masks["Nuclei"] == 0)
-nuclei_only = (masks["Nuclei"] > 0) & (masks["Lipids"] == 0)
-overlap = (masks["Lipids"] > 0) & (masks["Nuclei"] > 0)
+    # Look up each label's colour in the palette
+    color_mask = cv2.LUT(cv2.cvtColor(labels, cv2.COLOR_GRAY2BGR), OVERLAY_LUT)
 
-# Apply colors
-color_mask[lipid_only] = green
-color_mask[nuclei_only] = orange
-color_mask[overlap] = purple
+    # Blend with original image
+    return cv2.addWeighted(image, 0.6, color_mask, 0.4, 0)
 
-# Blend with original image
-blended = cv2.addWeighted(image, 0.6, color_mask, 0.4, 0)
 
-# Save overlay to file
-overlay_path = os.path.splitext(file_path)[0] + "_mask_overlay.png"
-cv2.imwrite(overlay_path, blended)
-print(f"Overlay with masks saved: {overlay_path}")
+def save_overlay_image(overlay_path, image, labels):
+    with Profiling.stage("overlay"):
+        blended = render_overlay(image, labels)
+    with Profiling.stage("encode"):
+        cv2.imwrite(overlay_path, blended)
 
-# (Optional) show overlay in window
-cv2.imshow("Mask Overlay", blended)
-cv2.waitKey(0)
-cv2.destroyWindow("Mask Overlay")
 
 # ===============================
 # RESULTS CALCULATION
 # ===============================
-results = []
-total_pixels = h * w
-total_area_um2 = total_pixels * (MICRONS_PER_PIXEL ** 2)
-
-for cls_name, _ in CLASSES:
-    pixels = int(np.count_nonzero(masks[cls_name]))
-    area_um2 = pixels * (MICRONS_PER_PIXEL ** 2)
-    percent = (pixels / total_pixels) * 100.0 if total_pixels > 0 else 0.0
-    results.append({
-        "Class": cls_name,
-        "Pixel Count": pixels,
-        "Area (µm²)": area_um2,
-        "Percent of total (%)": percent
-    })
+def compute_results(pixel_counts, total_pixels):
+    """Pixel count, area and percent of the image for each class."""
+    results = []
+    for cls_name, _ in CLASSES:
+        pixels = pixel_counts[cls_name]
+        area_um2 = pixels * (MICRONS_PER_PIXEL ** 2)
+        percent = (pixels / total_pixels) * 100.0 if total_pixels > 0 else 0.0
+        results.append({
+            "Class": cls_name,
+            "Pixel Count": pixels,
+            "Area (µm²)": area_um2,
+            "Percent of total (%)": percent
+        })
+    return results
+
+
+def print_results(results, total_pixels):
+    for row in results:
+        print(f"{row['Class']}: {row['Pixel Count']} px, {row['Area (µm²)']:.2f} µm², {row['Percent of total (%)']:.2f}%")
+    print(f"Total pixels: {total_pixels}  |  Total area: {total_pixels * (MICRONS_PER_PIXEL ** 2):.2f} µm²")
+
 
 # ===============================
 # CSV OUTPUT (points + results + thresholds)
 # ===============================
-csv_path = os.path.splitext(file_path)[0] + "_points.csv"
-with open(csv_path, "w", newline="") as f:
-    writer = csv.writer(f)
-
-    # Section 1: Selected points
-    writer.writerow(["Class", "X", "Y", "H", "S", "V"])
-    for cls_name, pts in accepted_points.items():
-        for (xo, yo) in pts:
-            h_, s_, v_ = hsv_image[yo, xo]
-            writer.writerow([cls_name, xo, yo, int(h_), int(s_), int(v_)])
-
-    # Section 2: Area results
+def write_results_sections(writer, results, total_pixels, hsv_bounds):
+    """Area results, totals and HSV threshold sections of the CSV."""
+    # Area results
     writer.writerow([])
     writer.writerow(["--- AREA RESULTS ---"])
     writer.writerow(["Class", "Pixel Count", "Area (µm²)", "Percent of total (%)"])
@@ -327,64 +581,282 @@ with open(csv_path, "w", newline="") as f:
     # Totals row
     writer.writerow([])
     writer.writerow(["--- TOTALS ---"])
+    total_area_um2 = total_pixels * (MICRONS_PER_PIXEL ** 2)
     writer.writerow(["Total Image", total_pixels, total_area_um2, 100.0])
 
-    # Section 3: HSV thresholds
+    # HSV thresholds
     writer.writerow([])
     writer.writerow(["--- HSV THRESHOLDS (low→high) ---"])
     writer.writerow(["Class", "H_low", "S_low", "V_low", "H_high", "S_high", "V_high"])
     for cls_name in ["Lipids", "Nuclei"]:
-        low, high = hsv_bounds[cls_name]
-        writer.writerow([cls_name, *low, *high])
+        if cls_name in hsv_bounds:
+            low, high = hsv_bounds[cls_name]
+            writer.writerow([cls_name, *low, *high])
+
+
+def write_points_csv(csv_path, points, results, total_pixels, hsv_bounds):
+    """
+    Write the selected points, area results, totals and HSV thresholds.
+    points maps each class to a list of (x, y, h, s, v) samples.
+    """
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+
+        # Section 1: Selected points
+        writer.writerow(["Class", "X", "Y", "H", "S", "V"])
+        for cls_name, pts in points.items():
+            for (xo, yo, h_, s_, v_) in pts:
+                writer.writerow([cls_name, xo, yo, int(h_), int(s_), int(v_)])
+
+        # Sections 2 and 3: Area results, totals and HSV thresholds
+        write_results_sections(writer, results, total_pixels, hsv_bounds)
+
+
+def read_points_csv(csv_path):
+    """Read the selected points and HSV thresholds back from a _points.csv."""
+    points = {cls: [] for cls, _ in CLASSES}
+    hsv_bounds = {}
+    section = "points"
+    with open(csv_path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0] in ("Class", "Total Image"):
+                continue
+            if row[0].startswith("---"):
+                section = "hsv" if "HSV THRESHOLDS" in row[0] else "other"
+                continue
+            if section == "points" and row[0] in points:
+                points[row[0]].append(tuple(int(v) for v in row[1:6]))
+            elif section == "hsv":
+                values = [int(v) for v in row[1:7]]
+                hsv_bounds[row[0]] = (values[:3], values[3:])
+    return points, hsv_bounds
 
-print(f"CSV saved with points + results + thresholds: {csv_path}")
-for row in results:
-    print(f"{row['Class']}: {row['Pixel Count']} px, {row['Area (µm²)']:.2f} µm², {row['Percent of total (%)']:.2f}%")
-print(f"Total pixels: {total_pixels}  |  Total area: {total_area_um2:.2f} µm²")
 
-# =========================
-# Area calculations per class + totals and percentages
-# =========================
-results = []
-total_pixels = h * w
-
-for cls_name, _ in CLASSES:
-    pixels = int(np.sum(masks[cls_name] > 0))
-    area_um2 = pixels * (MICRONS_PER_PIXEL ** 2)
-    percent = (pixels / total_pixels) * 100.0 if total_pixels > 0 else 0.0
-    results.append({
-        "Class": cls_name,
-        "Pixel Count": pixels,
-        "Area (µm²)": area_um2,
-        "Percent of total (%)": percent
-    })
-
-# Append results + totals to same CSV
-with open(csv_path, "a", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow([])
-    writer.writerow(["--- AREA RESULTS ---"])
-    writer.writerow(["Class", "Pixel Count", "Area (µm²)", "Percent of total (%)"])
-    for row in results:
-        writer.writerow([row["Class"], row["Pixel Count"], row["Area (µm²)"], row["Percent of total (%)"]])
-
-    # Totals row
-    writer.writerow([])
-    writer.writerow(["--- TOTALS ---"])
-    total_area_um2 = total_pixels * (MICRONS_PER_PIXEL ** 2)
-    writer.writerow(["Total Image", total_pixels, total_area_um2, 100.0])
+# ===============================
+# CALIBRATION PROFILES
+# ===============================
+def make_profile(points, hsv_bounds, lipid_thresh=LIPID_THRESH, nuclei_thresh=NUCLEI_THRESH,
+                 nuclei_min_blue=NUCLEI_MIN_BLUE):
+    """
+    Everything an interactive session decides, so later images can be analysed without the GUI.
+    points maps each class to (x, y, h, s, v) samples from the calibration image.
+    """
+    return {
+        "points": {cls_name: [list(map(int, pt)) for pt in pts] for cls_name, pts in points.items()},
+        "hsv_bounds": {cls_name: [list(low), list(high)] for cls_name, (low, high) in hsv_bounds.items()},
+        "lipid_thresh": lipid_thresh,
+        "nuclei_thresh": nuclei_thresh,
+        "nuclei_min_blue": nuclei_min_blue,
+        "nuclei_erode_radius_px": NUCLEI_ERODE_RADIUS_PX,
+        "nuclei_erode_iter": NUCLEI_ERODE_ITER,
+        "microns_per_pixel": MICRONS_PER_PIXEL,
+    }
+
+
+def save_profile(profile_path, profile):
+    with open(profile_path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def load_profile(profile_path):
+    """Load a profile saved by save_profile, or build one from an existing _points.csv."""
+    if profile_path.lower().endswith(".csv"):
+        return make_profile(*read_points_csv(profile_path))
+    with open(profile_path) as f:
+        profile = json.load(f)
+    defaults = make_profile({}, {})
+    return {**defaults, **profile}
+
+
+def mask_settings(profile):
+    """The keyword arguments of build_masks/build_masks_tiled set by a profile."""
+    return {key: profile[key] for key in ("lipid_thresh", "nuclei_thresh", "nuclei_min_blue")}
 
-# (Optional) save HSV thresholds used — helps reproducibility
-with open(csv_path, "a", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow([])
-    writer.writerow(["--- HSV THRESHOLDS (low→high) ---"])
-    writer.writerow(["Class", "H_low", "S_low", "V_low", "H_high", "S_high", "V_high"])
-    for cls_name in ["Lipids", "Nuclei"]:
-        low, high = hsv_bounds[cls_name]
-        writer.writerow([cls_name, *low, *high])
 
-print("Area results + totals appended to CSV.")
-for row in results:
-    print(f"{row['Class']}: {row['Pixel Count']} px, {row['Area (µm²)']:.2f} µm², {row['Percent of total (%)']:.2f}%")
-print(f"Total pixels: {total_pixels}  |  Total area: {total_area_um2:.2f} µm²")
+# ===============================
+# HEADLESS ANALYSIS
+# ===============================
+def output_stem(file_path, standardize=False):
+    """Path prefix of an image's output files; runs on white balanced images get their own files."""
+    stem = os.path.splitext(file_path)[0]
+    return stem + "_standardized" if standardize else stem
+
+
+def analyze_image(file_path, profile, tiled=False, save_overlay=False, standardize=False):
+    """
+    Analyse one image with a calibration profile and no GUI. Writes the _labels.npz label map, the
+    _objects.npz object table and (if save_overlay) the overlay, or the _labels.npy memory-mapped
+    label map if tiled (array files only, see open_tiled). With standardize the image is white balanced
+    in memory first, as -s would, so it cannot be combined with tiled.
+    Returns (results, total_pixels).
+    Results are cached by image contents and settings; a cached result is only used while its output
+    files are the ones it wrote, not deleted or overwritten by a run with other settings.
+    """
+    stem = output_stem(file_path, standardize)
+    if tiled:
+        outputs = [stem + "_labels.npy"]
+    else:
+        outputs = [stem + "_labels.npz", stem + "_objects.npz"] + ([stem + "_mask_overlay.png"] if save_overlay else [])
+
+    params = {
+        "profile": profile,
+        "tiled": tiled,
+        "save_overlay": save_overlay,
+        "microns_per_pixel": MICRONS_PER_PIXEL,
+        "cleanup_radius_px": CLEANUP_RADIUS_PX,
+    }
+    if standardize:
+        params["standardize"] = ImageStandardizer.settings()
+    results, total_pixels = ResultCache.cached(
+        "lipid_nuclei", file_path, params,
+        lambda: compute_analysis(file_path, profile, tiled, save_overlay, standardize),
+        output_paths=outputs)
+    return results, total_pixels
+
+
+def compute_analysis(file_path, profile, tiled, save_overlay, standardize=False):
+    """The uncached work of analyze_image."""
+    if tiled and standardize:
+        raise ValueError("Tiled runs cannot white balance, which needs the whole image in memory.")
+    if tiled:
+        image = open_tiled(file_path)
+    elif standardize:
+        image = ImageStandardizer.load_standardized(file_path)  # BGR, like cv2.imread
+    else:
+        with Profiling.stage("decode"):
+            image = imread(file_path)
+    if image is None:
+        raise ValueError(f"Could not read the image {file_path}.")
+    h, w = image.shape[:2]
+    stem = output_stem(file_path, standardize)
+
+    if tiled:
+        with Profiling.stage("masks_tiled"):
+            pixel_counts = build_masks_tiled(image, stem + "_labels.npy", **mask_settings(profile))
+    else:
+        masks = build_masks(image, **mask_settings(profile))
+        with Profiling.stage("labels"):
+            labels = label_map(masks)
+            pixel_counts = label_counts(labels)
+            save_labels(stem + "_labels.npz", labels)
+        if save_overlay:
+            save_overlay_image(stem + "_mask_overlay.png", image, labels)
+        with Profiling.stage("objects"):
+            objects = ObjectMeasurements.measure_objects(masks, MICRONS_PER_PIXEL)
+            ObjectMeasurements.save_objects(stem + "_objects.npz", objects)
+
+    total_pixels = h * w
+    return compute_results(pixel_counts, total_pixels), total_pixels
+
+
+def analyze_array(image, profile):
+    """Results of analysing a BGR array already in memory with a profile, writing no files. Returns (results, total_pixels)."""
+    masks = build_masks(image, **mask_settings(profile))
+    with Profiling.stage("labels"):
+        pixel_counts = label_counts(label_map(masks))
+    total_pixels = image.shape[0] * image.shape[1]
+    return compute_results(pixel_counts, total_pixels), total_pixels
+
+
+def results_record(file_path, results, total_pixels, profile, standardize=False):
+    """The results of one image as a ResultsStore record, with the settings that produced them."""
+    rows = [{"class": row["Class"], "pixel_count": row["Pixel Count"], "area_um2": row["Area (µm²)"],
+             "percent": row["Percent of total (%)"]} for row in results]
+    rows.append({"class": "Total Image", "pixel_count": total_pixels,
+                 "area_um2": total_pixels * (MICRONS_PER_PIXEL ** 2), "percent": 100.0})
+    params = {**mask_settings(profile), "hsv_bounds": profile["hsv_bounds"], "microns_per_pixel": MICRONS_PER_PIXEL,
+              "standardize": standardize}
+    return {"analysis": "lipid_nuclei", "image": file_path, "params": params, "rows": rows}
+
+
+def analyze_with_profile(file_path, profile_path, save_overlay=False, standardize=False, tiled=False):
+    """
+    analyze_image for main.run_script: loads the profile and returns the results record. With tiled,
+    array files are analysed tile by tile and other formats, which are decoded whole anyway, as usual.
+    """
+    profile = load_profile(profile_path)
+    tiled = tiled and ImageLoader.is_array_file(file_path)
+    results, total_pixels = analyze_image(file_path, profile, tiled, save_overlay, standardize)
+    return results_record(file_path, results, total_pixels, profile, standardize)
+
+
+def format_results_record(record):
+    """Printable summary of a record from analyze_with_profile."""
+    summary = [f"\nThe image {os.path.basename(record['image'])}:"]
+    for row in record["rows"][:-1]:
+        summary.append(f"{row['class']}: {row['pixel_count']} px, {row['area_um2']:.2f} µm², {row['percent']:.2f}%")
+    return "\n".join(summary) + "\n"
+
+
+def render_saved_overlay(file_path, overlay_path=None, max_size=None, standardize=False):
+    """Render the overlay of an analysed image from its saved label map, on request. Returns the overlay path."""
+    stem = output_stem(file_path, standardize)
+    labels = load_labels(stem + "_labels.npz")
+    image = ImageStandardizer.load_standardized(file_path) if standardize else read_image(file_path)
+    overlay_path = overlay_path or stem + "_mask_overlay.png"
+    cv2.imwrite(overlay_path, render_overlay(image, labels, max_size))
+    return overlay_path
+
+
+def main(tiled=False, save_overlay=False):
+    file_path = choose_file()
+    if tiled and not ImageLoader.is_array_file(file_path):
+        raise SystemExit("--tiled needs a .npy or raw array file, other formats are decoded whole into memory.")
+    image = read_image(file_path)
+    h, w = image.shape[:2]
+    stem = os.path.splitext(file_path)[0]
+
+    selector = PointSelector(image, file_path)
+    accepted_points, hsv_samples = selector.run()
+    settings = selector.mask_settings  # thresholds as left on the preview sliders
+    hsv_bounds = hsv_bounds_from_samples(hsv_samples)
+    points = {cls_name: [(xo, yo, *pixel_hsv(image, xo, yo)) for (xo, yo) in pts]
+              for cls_name, pts in accepted_points.items()}
+
+    if tiled:
+        # Labels go to a memory-mapped file instead of being held in memory
+        labels_path = stem + "_labels.npy"
+        pixel_counts = build_masks_tiled(image, labels_path, **settings)
+        print(f"Label map saved: {labels_path}")
+    else:
+        masks = build_masks(image, **settings)
+        labels = label_map(masks)
+        pixel_counts = label_counts(labels)
+
+        labels_path = stem + "_labels.npz"
+        save_labels(labels_path, labels)
+        print(f"Label map saved: {labels_path}")
+
+        # Save the full-size overlay to file only when asked for
+        if save_overlay:
+            overlay_path = stem + "_mask_overlay.png"
+            save_overlay_image(overlay_path, image, labels)
+            print(f"Overlay with masks saved: {overlay_path}")
+
+        # (Optional) show overlay in window, rendered at window size
+        cv2.imshow("Mask Overlay", render_overlay(image, labels, (MAX_DISPLAY_W, MAX_DISPLAY_H)))
+        cv2.waitKey(0)
+        cv2.destroyWindow("Mask Overlay")
+
+        # Per-nucleus and per-droplet measurements
+        objects_path = stem + "_objects.npz"
+        objects = ObjectMeasurements.measure_objects(masks, MICRONS_PER_PIXEL)
+        ObjectMeasurements.save_objects(objects_path, objects)
+        print(f"Object table saved ({len(objects['Nuclei']['id'])} nuclei, {len(objects['Lipids']['id'])} droplets): {objects_path}")
+
+    total_pixels = h * w
+    results = compute_results(pixel_counts, total_pixels)
+
+    csv_path = stem + "_points.csv"
+    write_points_csv(csv_path, points, results, total_pixels, hsv_bounds)
+    print(f"CSV saved with points + results + thresholds: {csv_path}")
+    print_results(results, total_pixels)
+
+    # Save the session as a calibration profile for headless runs
+    profile_path = stem + "_profile.json"
+    save_profile(profile_path, make_profile(points, hsv_bounds, **settings))
+    print(f"Calibration profile saved: {profile_path}")
+
+
+if __name__ == "__main__":
+    main(tiled="--tiled" in sys.argv[1:], save_overlay="--overlay" in sys.argv[1:])
@@ -0,0 +1,215 @@
+"""
+Watches a folder and analyses new or changed images as they arrive, using the same per-image
+worker function as main.py folder runs.
+
+    python WatchFolder.py captures --profile calibration_profile.json --workers 4
+    python WatchFolder.py captures --red 30 --areas SelectedAreaImages
+    python WatchFolder.py captures --standardize
+
+The folder listing is only read again when the folder itself changes (or every RESCAN_SECONDS, to
+catch files rewritten in place); between listings only files still being written are checked. A file
+is processed once its size and modification time have not changed for STABLE_SECONDS. Finished files
+are remembered in a JSON state file, so a restarted watcher only picks up what is new. Files that failed
+are only skipped until they change or the watcher is restarted. A worker process that crashes (e.g. an
+image crashed the decoder) is replaced, and the files it may have been on are run again one at a time,
+so only the one that crashes fails. Stop with Ctrl+C.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+
+from ImageStandardizer import standardize_image
+from main import is_image_file, run_func_safely
+from RelativeRed import format_relative_red, get_relative_red
+from ResultsStore import ResultsStore
+from UpdatedCodeLipidNuclei import analyze_with_profile, format_results_record
+
+POLL_SECONDS = 1.0       # how often the folder and the files being written are checked
+STABLE_SECONDS = 2.0     # a file must be unchanged this long before it is processed
+RESCAN_SECONDS = 60.0    # full listing even when the folder looks unchanged
+STATE_PATH = 'WatchState.json'
+
+# images the analyses write next to their input, which must not be analysed in turn
+OUTPUT_SUFFIXES = ('_mask_overlay.png',)
+
+
+def is_output_file(file_path):
+    return file_path.name.endswith(OUTPUT_SUFFIXES)
+
+
+# (modification time, size) of a file, a file whose signature changed is processed again
+def signature(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(state_path, done):
+    temp_path = f'{state_path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(done, f)
+    os.replace(temp_path, state_path)  # a crash mid-write never leaves a truncated state file
+
+
+"""
+Watches folder until stop is set (or forever), running function(image_path[, input]) on each new or
+changed image in a pool of worker processes. Outputs are printed through describe, like main.run_batch,
+and added to store if given.
+"""
+async def watch(folder, function, input = None, workers = 1, describe = None, store = None,
+                state_path = STATE_PATH, poll_seconds = POLL_SECONDS, stable_seconds = STABLE_SECONDS,
+                rescan_seconds = RESCAN_SECONDS, stop = None):
+    loop = asyncio.get_running_loop()
+    folder = os.path.abspath(folder)  # state keys stay the same however the folder is given
+    done = load_state(state_path)
+    failed = {}     # path -> signature of files that failed in this run
+    pending = {}    # path -> (signature, time it was last seen changing)
+    running = set()
+    tasks = set()
+    changed = [False]  # state or store has unsaved results
+
+    # runs one image in a one-worker pool of its own, so a crash there cannot be blamed on other images
+    async def run_alone(image_path):
+        with ProcessPoolExecutor(max_workers=1) as alone:
+            try:
+                return await loop.run_in_executor(alone, run_func_safely, image_path, function, input)
+            except BrokenProcessPool:
+                return None, f'Error: {image_path} could not be processed (its worker process crashed)'
+
+    async def process(image_path, file_signature):
+        pool = executor[0]
+        try:
+            output, error = await loop.run_in_executor(pool, run_func_safely, image_path, function, input)
+        except BrokenProcessPool:
+            # every image running in the pool gets here; the first replaces the pool for later images
+            if executor[0] is pool:
+                executor[0] = ProcessPoolExecutor(max_workers=workers)
+                pool.shutdown(wait=False, cancel_futures=True)
+                print('A worker process crashed, running the images it may have been on one at a time.')
+            output, error = await run_alone(image_path)
+        except Exception as e:  # e.g. the output could not be sent back from the worker
+            output, error = None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})'
+        running.discard(image_path)
+        try:
+            current = signature(os.stat(image_path))
+        except FileNotFoundError:
+            return
+        if current != file_signature:
+            pending[image_path] = (current, time.monotonic())  # still being written, process it again once stable
+            return
+        if error:
+            # not saved in the state file, so failed files are retried when they change or after a restart
+            print(error)
+            failed[image_path] = file_signature
+            return
+        if output:
+            print(describe(output) if describe else output)
+            if store is not None:
+                store.add(output)
+        done[image_path] = file_signature
+        changed[0] = True
+
+    def scan(now):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                path = Path(entry.path)
+                if not entry.is_file() or not is_image_file(path) or is_output_file(path):
+                    continue
+                file_signature = signature(entry.stat())
+                if file_signature in (done.get(entry.path), failed.get(entry.path)) or entry.path in running:
+                    continue
+                if entry.path not in pending or pending[entry.path][0] != file_signature:
+                    pending[entry.path] = (file_signature, now)
+
+    workers = workers or os.cpu_count() or 1
+    executor = [ProcessPoolExecutor(max_workers=workers)]  # replaced when a worker crash breaks it
+    last_folder_mtime, last_scan = None, float('-inf')
+    print(f'Watching {folder} for new images (Ctrl+C to stop).')
+    try:
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            folder_mtime = os.stat(folder).st_mtime_ns
+            if folder_mtime != last_folder_mtime or now - last_scan >= rescan_seconds:
+                scan(now)
+                last_folder_mtime, last_scan = folder_mtime, now
+
+            # only files still settling are checked again
+            for image_path, (file_signature, since) in list(pending.items()):
+                try:
+                    current = signature(os.stat(image_path))
+                except FileNotFoundError:
+                    del pending[image_path]
+                    continue
+                if current != file_signature:
+                    pending[image_path] = (current, now)
+                elif now - since >= stable_seconds:
+                    del pending[image_path]
+                    running.add(image_path)
+                    task = asyncio.create_task(process(image_path, file_signature))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            if changed[0]:
+                save_state(state_path, done)
+                if store is not None:
+                    store.flush()
+                changed[0] = False
+            await asyncio.sleep(poll_seconds)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        executor[0].shutdown(wait=False, cancel_futures=True)
+        save_state(state_path, done)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Analyse new images as they appear in a folder.')
+    parser.add_argument('folder', help='folder to watch')
+    analysis = parser.add_mutually_exclusive_group(required=True)
+    analysis.add_argument('--red', type=int, metavar='THRESHOLD', help='percent red with this red threshold (0-255)')
+    analysis.add_argument('--profile', help='lipids/nuclei with this calibration profile')
+    analysis.add_argument('--standardize', action='store_true', help='write standardized images')
+    parser.add_argument('--areas', help='saved areas file/directory, required with --red')
+    parser.add_argument('--union', action='store_true', help='count overlapping areas once (--red)')
+    parser.add_argument('--overlay', action='store_true', help='save full-size overlay images (--profile)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 for one per CPU core')
+    parser.add_argument('--state', default=STATE_PATH, help='file remembering which images are done')
+    parser.add_argument('--stable', type=float, default=STABLE_SECONDS,
+                        help='seconds a file must stay unchanged before it is processed')
+    args = parser.parse_args(argv)
+
+    if args.red is not None:
+        if not args.areas:
+            parser.error('--red needs --areas, there is nobody to select areas in watch mode')
+        function, input = partial(get_relative_red, roi_path=args.areas, union=args.union), args.red
+        describe = format_relative_red
+    elif args.profile:
+        function, input = partial(analyze_with_profile, save_overlay=args.overlay), args.profile
+        describe = format_results_record
+    else:
+        function, input, describe = standardize_image, None, None
+
+    with ResultsStore() as store:
+        try:
+            # standardizing only writes images, it has no results to store
+            asyncio.run(watch(args.folder, function, input, args.workers, describe,
+                              None if args.standardize else store, args.state, stable_seconds=args.stable))
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+Sharded batch runs over a work queue kept in a plain shared directory, with no server or broker.
+
+    python WorkQueue.py create /shared/queue /shared/study --profile calibration_profile.json
+    python WorkQueue.py work /shared/queue --workers 8        (on every host, as many times as wanted)
+    python WorkQueue.py status /shared/queue
+    python WorkQueue.py merge /shared/queue                   (once all items are done)
+
+The queue directory holds job.json (the analysis and its settings) and one small file per image,
+moved between todo/, claimed/, done/ and failed/. A worker claims an item by renaming it from todo/
+into claimed/, which succeeds for exactly one worker. While it works on an item it touches the claim
+every HEARTBEAT_SECONDS; claims left untouched for CLAIM_TIMEOUT_SECONDS (a crashed worker or host) are
+moved back to todo/ by whichever worker notices first. Each item runs in a child process of the
+worker, so an image that crashes the interpreter only fails itself, and every claim is counted in the
+item file, so an item that keeps taking its worker or host down is given up after MAX_ATTEMPTS.
+Items that failed end up in failed/. Each worker appends its results to its own shard in results/,
+and merge combines the shards into the results database.
+
+Image paths are stored as absolute paths, so the shared directory must be mounted at the same path
+on every host.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import Process
+from pathlib import Path
+
+from ImageStandardizer import standardize_image
+from main import image_files, is_image_file, run_func_safely
+from RelativeRed import get_relative_red
+from ResultsStore import ResultsStore
+from UpdatedCodeLipidNuclei import analyze_with_profile
+
+HEARTBEAT_SECONDS = 30
+CLAIM_TIMEOUT_SECONDS = 300
+IDLE_SECONDS = 5          # wait before looking again when only other workers' claims are left
+MAX_ATTEMPTS = 3          # claims of one item before it is given up as failed
+
+
+def queue_dirs(queue_dir):
+    return {name: os.path.join(queue_dir, name) for name in ('todo', 'claimed', 'done', 'failed', 'results')}
+
+
+# writes a file so that readers on any host see either nothing or the whole file
+def write_atomic(path, value):
+    temp_path = f'{path}.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+
+def create_queue(queue_dir, image_paths, job):
+    dirs = queue_dirs(queue_dir)
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    write_atomic(os.path.join(queue_dir, 'job.json'), job)
+    for number, image_path in enumerate(image_paths):
+        write_atomic(os.path.join(dirs['todo'], f'{number:08d}.json'), {'image': os.path.abspath(image_path)})
+    print(f'Queued {len(image_paths)} images in {queue_dir}.')
+
+
+# the function and input main.run_func_safely runs for each image of a job
+def job_function(job):
+    if job['analysis'] == 'relative_red':
+        return partial(get_relative_red, roi_path=job['areas'], union=job['union']), job['threshold']
+    if job['analysis'] == 'lipid_nuclei':
+        return partial(analyze_with_profile, save_overlay=job['save_overlay']), job['profile']
+    return standardize_image, None
+
+
+# moves claims nobody has touched for CLAIM_TIMEOUT_SECONDS back to todo/. Returns the number reclaimed.
+def reclaim_stale(dirs, timeout=CLAIM_TIMEOUT_SECONDS):
+    reclaimed = 0
+    for name in os.listdir(dirs['claimed']):
+        path = os.path.join(dirs['claimed'], name)
+        try:
+            if time.time() - os.stat(path).st_mtime < timeout:
+                continue
+            os.rename(path, os.path.join(dirs['todo'], name.split('.')[0] + '.json'))
+            reclaimed += 1
+        except FileNotFoundError:
+            pass  # finished or reclaimed by someone else in the meantime
+    return reclaimed
+
+
+# claims one item, returning (item id, claim path), or None when todo/ is empty
+def claim(dirs, worker_id):
+    names = os.listdir(dirs['todo'])
+    random.shuffle(names)  # workers starting together don't all race for the same item
+    for name in names:
+        if name.endswith('.tmp'):
+            continue
+        item_id = name.split('.')[0]
+        todo_path = os.path.join(dirs['todo'], name)
+        claim_path = os.path.join(dirs['claimed'], f'{item_id}.{worker_id}.json')
+        try:
+            # touched before the rename, which keeps the mtime, so the claim's age counts from now rather
+            # than from when the item was queued and no other worker takes it for a stale claim
+            os.utime(todo_path)
+            os.rename(todo_path, claim_path)
+            os.utime(claim_path)
+        except FileNotFoundError:
+            continue  # another worker claimed it first, or (rarely) reclaimed it straight back
+        return item_id, claim_path
+    return None
+
+
+# keeps touching a claim until stop is set, so it is not taken for a crashed worker's
+def heartbeat(claim_path, stop, interval=HEARTBEAT_SECONDS):
+    while not stop.wait(interval):
+        try:
+            os.utime(claim_path)
+        except FileNotFoundError:
+            return
+
+
+# runs one item in the worker's child process. Returns (output, error); a crash of the child replaces it.
+def run_item(pool, image_path, function, input):
+    try:
+        return pool[0].submit(run_func_safely, image_path, function, input).result()
+    except BrokenProcessPool:
+        pool[0].shutdown(wait=False)
+        pool[0] = ProcessPoolExecutor(max_workers=1)
+        return None, f'Error: {image_path} could not be processed (its worker process crashed)'
+    except Exception as e:  # e.g. the output could not be sent back from the child
+        return None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})'
+
+
+"""
+Processes items from the queue until none are left, appending one JSON line per item to this
+worker's shard in results/. Returns the number of items processed.
+"""
+def work(queue_dir, timeout=CLAIM_TIMEOUT_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, max_attempts=MAX_ATTEMPTS):
+    dirs = queue_dirs(queue_dir)
+    os.makedirs(dirs['failed'], exist_ok=True)  # queues created before failed/ existed
+    with open(os.path.join(queue_dir, 'job.json')) as f:
+        function, input = job_function(json.load(f))
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    shard_path = os.path.join(dirs['results'], f'{worker_id}.jsonl')
+    processed = 0
+    pool = [ProcessPoolExecutor(max_workers=1)]  # the child process items run in
+
+    try:
+        with open(shard_path, 'a') as shard:
+            while True:
+                claimed = claim(dirs, worker_id)
+                if claimed is None:
+                    if reclaim_stale(dirs, timeout):
+                        continue
+                    if not os.listdir(dirs['claimed']):
+                        break  # nothing queued and nothing in progress anywhere
+                    time.sleep(IDLE_SECONDS)  # other workers' items may still come back if they crash
+                    continue
+
+                item_id, claim_path = claimed
+                try:
+                    with open(claim_path) as f:
+                        item = json.load(f)
+                    # counted before the run: if it takes this worker or host down, the next claim sees it
+                    item['attempts'] = item.get('attempts', 0) + 1
+                    write_atomic(claim_path, item)
+                except FileNotFoundError:
+                    continue  # reclaimed by another worker before it was read, it is back in todo/
+                image_path = item['image']
+
+                if item['attempts'] > max_attempts:
+                    output, error = None, (f'Error: {image_path} could not be processed (given up after '
+                                           f'{max_attempts} attempts, its worker kept stopping)')
+                else:
+                    stop = threading.Event()
+                    beat = threading.Thread(target=heartbeat, args=(claim_path, stop, heartbeat_seconds), daemon=True)
+                    beat.start()
+                    try:
+                        output, error = run_item(pool, image_path, function, input)
+                    finally:
+                        stop.set()
+                        beat.join()
+
+                shard.write(json.dumps({'id': item_id, 'image': image_path, 'output': output, 'error': error,
+                                        'worker': worker_id, 'time': time.time()}) + '\n')
+                shard.flush()
+                os.fsync(shard.fileno())  # the result is on disk before the item is marked done
+                try:
+                    os.rename(claim_path, os.path.join(dirs['failed' if error else 'done'], f'{item_id}.json'))
+                except FileNotFoundError:
+                    pass  # the claim was reclaimed meanwhile; merge keeps one result per item
+                print(error or f'{worker_id}: processed {image_path}')
+                processed += 1
+    finally:
+        pool[0].shutdown()
+    return processed
+
+
+def run_workers(queue_dir, workers):
+    processes = [Process(target=work, args=(queue_dir,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def status(queue_dir):
+    dirs = queue_dirs(queue_dir)
+    counts = {name: len([n for n in os.listdir(dirs[name]) if not n.endswith('.tmp')]) if os.path.isdir(dirs[name]) else 0
+              for name in ('todo', 'claimed', 'done', 'failed')}
+    print(f"{counts['todo']} queued, {counts['claimed']} in progress, {counts['done']} done, {counts['failed']} failed.")
+    return counts
+
+
+"""
+Combines the result shards: one result per item (the latest, should an item have been processed twice
+after a reclaim). Records are added to store if given. Returns (records, errors).
+"""
+def merge(queue_dir, store=None):
+    results_dir = queue_dirs(queue_dir)['results']
+    latest = {}
+    for name in sorted(os.listdir(results_dir)):
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(results_dir, name)) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if result['id'] not in latest or result['time'] >= latest[result['id']]['time']:
+                        latest[result['id']] = result
+
+    records, errors = [], []
+    for item_id in sorted(latest):
+        result = latest[item_id]
+        if result['error']:
+            errors.append(result['error'])
+        elif isinstance(result['output'], dict):
+            records.append(result['output'])
+            if store is not None:
+                store.add(result['output'])
+    return records, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sharded batch runs over a shared-directory work queue.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='queue every image of a folder (or one image)')
+    create.add_argument('queue', help='shared queue directory')
+    create.add_argument('images', help='image or folder of images')
+    analysis = create.add_mutually_exclusive_group(required=True)
+    analysis.add_argument('--red', type=int, metavar='THRESHOLD', help='percent red with this red threshold (0-255)')
+    analysis.add_argument('--profile', help='lipids/nuclei with this calibration profile')
+    analysis.add_argument('--standardize', action='store_true', help='write standardized images')
+    create.add_argument('--areas', help='saved areas file/directory, required with --red')
+    create.add_argument('--union', action='store_true', help='count overlapping areas once (--red)')
+    create.add_argument('--overlay', action='store_true', help='save full-size overlay images (--profile)')
+
+    worker = commands.add_parser('work', help='process queued images until none are left')
+    worker.add_argument('queue')
+    worker.add_argument('--workers', type=int, default=1, help='worker processes on this host, 0 for one per CPU core')
+
+    commands.add_parser('status', help='count queued, in progress and done images').add_argument('queue')
+
+    merger = commands.add_parser('merge', help='add the results of all workers to the results database')
+    merger.add_argument('queue')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        if args.red is not None:
+            if not args.areas:
+                parser.error('--red needs --areas, workers cannot open selection windows')
+            job = {'analysis': 'relative_red', 'threshold': args.red, 'areas': os.path.abspath(args.areas),
+                   'union': args.union}
+        elif args.profile:
+            job = {'analysis': 'lipid_nuclei', 'profile': os.path.abspath(args.profile), 'save_overlay': args.overlay}
+        else:
+            job = {'analysis': 'standardize'}
+        path = Path(args.images)
+        image_paths = image_files(path) if path.is_dir() else [str(path)] if is_image_file(path) else []
+        create_queue(args.queue, image_paths, job)
+    elif args.command == 'work':
+        run_workers(args.queue, args.workers or os.cpu_count() or 1)
+    elif args.command == 'status':
+        status(args.queue)
+    else:
+        with ResultsStore() as store:
+            records, errors = merge(args.queue, store)
+        for error in errors:
+            print(error)
+        print(f'Merged {len(records)} results into {store.path} ({len(errors)} images failed).')
+        status(args.queue)
+
+
+if __name__ == '__main__':
+    main()
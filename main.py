@@ -1,65 +1,464 @@
+import argparse
 import os
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
-from ImageStandardizer import standardize_image
-from RelativeRed import get_relative_red
+import Profiling
+from ResultsStore import RESULTS_PATH, ResultsStore
+
+# Modules that load OpenCV, NumPy, PIL or tkinter are imported by the commands that use them, not here,
+# so starting main.py (or a worker process importing it) only pays for what the chosen command needs.
 
 # check is a filepath is for an image
 def is_image_file(file_path):
+    import ImageLoader
     # Define a set of accepted image file extensions
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff'}
+    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff'} | ImageLoader.ARRAY_EXTENSIONS
     return file_path.suffix.lower() in image_extensions
 
 
-def run_func_on_image(image_path, func, input):
-    if input:
-        output = func(image_path, input) # Process image
-    else:
-        output = func(image_path)
+# describe turns an output into the text printed for it, store receives every output as a ResultsStore record.
+def run_func_on_image(image_path, func, input, show_output = True, describe = None, store = None):
+    with Profiling.image_record(image_path):
+        if input is not None:
+            output = func(image_path, input) # Process image
+        else:
+            output = func(image_path)
     if output:
-        print(output)
+        if show_output:
+            print(describe(output) if describe else output)
+        if store is not None:
+            store.add(output)
         return output
     return None
 
 
+# runs a function on one image in a worker, returning (output, error) so one bad image doesn't stop a batch.
+def run_func_safely(image_path, func, input):
+    import ImageLoader
+    try:
+        with Profiling.image_record(image_path):
+            if input is not None:
+                return func(image_path, input), None
+            return func(image_path), None
+    except Exception as e:
+        return None, f'Error: {image_path} could not be processed ({type(e).__name__}: {e})'
+    finally:
+        ImageLoader.release(image_path)  # decoded copies are only shared within one image's task
+
+
+"""
+Runs a function on every image path using a pool of worker processes, one image per task.
+Returns the outputs in the same order as image_paths, with None for images that failed.
+"""
+def run_batch(image_paths, function, input = None, workers = 1, show_output = True, describe = None, store = None):
+    outputs = [None] * len(image_paths)
+    total = len(image_paths)
+    workers = workers or os.cpu_count() or 1
+
+    # outputs come back to this process, so the store has a single writer however many workers run
+    def record(index, output, error, done):
+        if error:
+            print(error)
+        elif output:
+            if show_output:
+                print(describe(output) if describe else output)
+            if store is not None:
+                store.add(output)
+            outputs[index] = output
+        print(f'Processed {done}/{total} images.')
+
+    profile_offset = Profiling.records_offset()
+
+    if workers == 1 or total <= 1:
+        for index, image_path in enumerate(image_paths):
+            output, error = run_func_safely(image_path, function, input)
+            record(index, output, error, index + 1)
+    else:
+        run_pool(image_paths, function, input, workers, record)
+    if store is not None:
+        store.flush()
+
+    # Stage timings of this batch when profiling is on
+    if Profiling.enabled() and os.path.exists(Profiling.records_path):
+        Profiling.print_summary(Profiling.summarize(Profiling.read_records(Profiling.records_path, profile_offset)))
+    return outputs
+
+
+"""
+Runs the images in a process pool, calling record for each as it finishes. A worker that dies (e.g. an
+image crashed the decoder) breaks the whole pool, so the images that were running then are run again one
+at a time, to fail only the one that crashes, and the rest of the folder continues in a fresh pool.
+"""
+def run_pool(image_paths, function, input, workers, record):
+    todo = deque(range(len(image_paths)))
+    done = [0]
+
+    def finish(index, output, error):
+        done[0] += 1
+        record(index, output, error, done[0])
+
+    while todo:
+        suspects = run_until_broken(image_paths, todo, function, input, min(workers, len(todo)), finish)
+        if suspects:
+            print(f'A worker process crashed, running the {len(suspects)} images it may have been on one at a time.')
+        for index in suspects:
+            if run_until_broken(image_paths, deque([index]), function, input, 1, finish):
+                finish(index, None, f'Error: {image_paths[index]} could not be processed (its worker process crashed)')
+
+
+"""
+Takes images from the todo deque into a pool, keeping only as many in flight as there are workers, so a
+crash involves no more images than that. Returns the images that were in flight if the pool broke (the
+rest stay in todo), or an empty list once todo is done.
+"""
+def run_until_broken(image_paths, todo, function, input, workers, finish):
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while todo or running:
+            while todo and len(running) < workers:
+                index = todo.popleft()
+                running[executor.submit(run_func_safely, image_paths[index], function, input)] = index
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                try:
+                    output, error = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    continue
+                except Exception as e:  # e.g. the output could not be sent back from the worker
+                    output, error = None, f'Error: {image_paths[running[future]]} could not be processed ({type(e).__name__}: {e})'
+                finish(running.pop(future), output, error)
+            if broken:
+                return sorted(running.values())
+    return []
+
+
+"""
+Runs an analysis chained after standardization: the analysis is given standardize=True so it works on the
+white balanced array in memory. With save_standardized the standardized image is written too, from the
+same array, so nothing is decoded twice.
+"""
+def standardize_then(function, save_standardized, image_path, input = None):
+    from ImageStandardizer import standardize_image
+    if save_standardized:
+        standardize_image(image_path)
+    if input is not None:
+        return function(image_path, input, standardize=True)
+    return function(image_path, standardize=True)
+
+
+# the image files directly inside a directory, sorted by name
+def image_files(directory):
+    return [str(file) for file in sorted(Path(directory).iterdir()) if file.is_file() and is_image_file(file)]
+
+
 # This will run a provided function on either an image or all the images in a directory.
-def run_script(input_path, function, input = None):
+def run_script(input_path, function, input = None, workers = 1, show_output = True, describe = None, store = None):
     # Convert input to a Path object for easier handling
     path = Path(input_path)
     outputs = []
 
     # Check if the path is a file and an image
     if path.is_file() and is_image_file(path):
-        outputs.append(run_func_on_image(str(path), function, input))
+        outputs.append(run_func_on_image(str(path), function, input, show_output, describe, store))
     elif path.is_dir():
-        # Loop through each file in the directory
-        for file in path.iterdir():
-            if file.is_file() and is_image_file(file):  # Check if it's a file and an image
-                outputs.append(run_func_on_image(str(path), function, input))
+        # Collect each image file in the directory, then process them in a batch
+        image_paths = image_files(path)
+        outputs = run_batch(image_paths, function, input, workers, show_output, describe, store)
     else:
         print(f'Error: {input_path} is neither a image nor a directory.')
 
     return outputs
 
 
+# ===== commands, run from the command line or the interactive menu with the same settings =====
+
+def standardize_command(args):
+    from ImageStandardizer import OUTPUT_DIR, standardize_batch, standardize_image
+    if Path(args.path).is_dir():
+        # folders go through the pipelined batch, reading, computing and writing at the same time
+        standardize_batch(image_files(args.path), args.format, args.png_compression, args.workers,
+                          output_dir=args.output or OUTPUT_DIR)
+    else:
+        run_script(args.path, partial(standardize_image, output_format=args.format,
+                                      png_compression=args.png_compression, output_dir=args.output or OUTPUT_DIR))
+
+
+def red_command(args):
+    from RelativeRed import format_relative_red, get_relative_red
+    function = partial(get_relative_red, roi_path=args.areas, union=args.union)
+    if args.standardize:
+        function = partial(standardize_then, function, args.save_standardized)
+    with ResultsStore(args.output) as store:
+        run_script(args.path, function, args.threshold, args.workers, describe=format_relative_red, store=store)
+    print(f'Results saved to {store.path}')
+
+
+def sweep_command(args):
+    from RelativeRed import red_threshold_sweep, write_sweep_table
+    sweeps = run_script(args.path, partial(red_threshold_sweep, roi_path=args.areas, union=args.union),
+                        workers=args.workers, show_output=False)
+    write_sweep_table(args.output, [sweep for sweep in sweeps if sweep])
+
+
+def lipid_command(args):
+    from UpdatedCodeLipidNuclei import analyze_with_profile, format_results_record
+    if args.tiled and args.standardize:
+        print('Error: --tiled cannot be combined with --standardize, white balancing needs the whole image in memory.')
+        return
+    function = partial(analyze_with_profile, save_overlay=args.overlay, tiled=args.tiled)
+    if args.standardize:
+        function = partial(standardize_then, function, args.save_standardized)
+    with ResultsStore(args.output) as store:
+        run_script(args.path, function, args.profile, args.workers, describe=format_results_record, store=store)
+    print(f'Results saved to {store.path}')
+
+
+def stack_command(args):
+    import FrameStack
+    image_paths = image_files(args.path) if Path(args.path).is_dir() else [args.path]
+    if args.red is not None:
+        from RelativeRed import get_areas
+        # the areas of each stack apply to every frame
+        settings_for = lambda path: {'threshold': args.red, 'areas': get_areas(path, args.areas), 'union': args.union}
+        analysis = 'relative_red'
+    elif args.profile:
+        from UpdatedCodeLipidNuclei import load_profile
+        profile = load_profile(args.profile)
+        settings_for = lambda path: {'profile': profile}
+        analysis = 'lipid_nuclei'
+    else:
+        from ImageStandardizer import OUTPUT_DIR
+        settings_for = lambda path: {'output_dir': args.output or OUTPUT_DIR}
+        FrameStack.run_stacks(image_paths, 'standardize', settings_for, args.workers)
+        return
+    with ResultsStore(args.output or RESULTS_PATH) as store:
+        FrameStack.run_stacks(image_paths, analysis, settings_for, args.workers, store)
+    print(f'Results saved to {store.path}')
+
+
+def screen_command(args):
+    import Screening
+    from UpdatedCodeLipidNuclei import load_profile
+    max_pixels = args.pixels or Screening.SAMPLE_PIXELS
+    path = Path(args.path)
+    image_paths = image_files(path) if path.is_dir() else [str(path)] if path.is_file() else []
+
+    # the error of reduced decodes is calibrated on the first few of them
+    if args.red is not None:
+        estimate = partial(Screening.estimate_red, red_threshold=args.red, max_pixels=max_pixels)
+        full = partial(Screening.full_red, red_threshold=args.red)
+    elif args.cls == 'Nuclei':
+        estimate = full = None  # nuclei are never estimated from a reduced decode
+    else:
+        profile = load_profile(args.profile)
+        estimate = partial(Screening.estimate_lipid_nuclei, profile=profile, cls=args.cls, max_pixels=max_pixels)
+        full = partial(Screening.full_lipid_nuclei, profile=profile, cls=args.cls)
+    margin, fulls = None, {}
+    if estimate is not None:
+        margin, fulls = Screening.calibrate_margin(image_paths, estimate, full, max_pixels)
+        if margin is None:
+            print('Too few reduced-resolution images to calibrate on, they are all checked at full resolution.')
+        elif fulls:
+            print(f'Reduced-resolution estimates calibrated on {len(fulls)} images: '
+                  f'intervals widened by {margin:.2f} percentage points.')
+
+    if args.red is not None:
+        function = partial(Screening.screen_red, red_threshold=args.red, cutoff=args.cutoff, max_pixels=max_pixels,
+                           margin=margin)
+    else:
+        function = partial(Screening.screen_lipid_nuclei, profile_path=args.profile, cutoff=args.cutoff,
+                           cls=args.cls, max_pixels=max_pixels, margin=margin)
+    with ResultsStore(args.output) as store:
+        # the calibration images were analysed at full resolution already, their results are used as they are
+        records = []
+        for image_path, percent in fulls.items():
+            records.append(function(image_path, full_percent=percent))
+            print(Screening.format_screen_record(records[-1]))
+            store.add(records[-1])
+        if fulls:
+            remaining = [image_path for image_path in image_paths if image_path not in fulls]
+            outputs = run_batch(remaining, function, None, args.workers, describe=Screening.format_screen_record,
+                                store=store)
+        else:
+            outputs = run_script(args.path, function, None, args.workers, describe=Screening.format_screen_record,
+                                 store=store)
+        records += [record for record in outputs if record]
+    flagged = sum(record['rows'][0]['flagged'] for record in records)
+    escalated = sum(record['rows'][0]['escalated'] for record in records)
+    print(f'{flagged} of {len(records)} images at or above the {args.cutoff:g}% cutoff '
+          f'({escalated} were checked at full resolution).')
+    print(f'Results saved to {store.path}')
+
+
+def clear_cache_command(args):
+    import ResultCache
+    if not ResultCache.enabled():
+        print('Result caching is off (LND_CACHE=off), there is nothing to clear.')
+        return
+    removed = ResultCache.cache.invalidate()
+    print(f'Removed {removed} cached results.')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Standardize images and measure red area or lipids/nuclei. '
+                                                 'Without arguments an interactive menu is shown.')
+    commands = parser.add_subparsers(dest='name', required=True)
+
+    # settings shared by the commands that run on an image or a folder
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument('path', help='image or folder of images')
+    run.add_argument('--workers', type=int, default=1, help='worker processes for folders, 0 for one per CPU core')
+
+    areas = argparse.ArgumentParser(add_help=False)
+    areas.add_argument('--areas', help='saved areas file/directory, areas are selected in a window otherwise')
+    areas.add_argument('--union', action='store_true', help='count overlapping areas once')
+
+    standardized = argparse.ArgumentParser(add_help=False)
+    standardized.add_argument('--standardize', action='store_true', help='white balance each image in memory first')
+    standardized.add_argument('--save-standardized', action='store_true', help='also save the standardized images')
+
+    command = commands.add_parser('standardize', parents=[run], help='white balance images')
+    command.add_argument('--format', default='png', help='output format (png, tif, jpg, ...)')
+    command.add_argument('--png-compression', type=int, help='PNG compression level, 0 fastest to 9 smallest')
+    command.add_argument('--output', help='folder for the standardized images (default StandardizedImages)')
+    command.set_defaults(command=standardize_command)
+
+    command = commands.add_parser('red', parents=[run, areas, standardized], help='percent red in the image and areas')
+    command.add_argument('--threshold', type=int, required=True, help='red threshold (0-255)')
+    command.add_argument('--output', default=RESULTS_PATH, help='results database')
+    command.set_defaults(command=red_command)
+
+    command = commands.add_parser('sweep', parents=[run, areas], help='percent red for every threshold (0-255)')
+    command.add_argument('--output', default='threshold_sweep.csv', help='table of the results')
+    command.set_defaults(command=sweep_command)
+
+    command = commands.add_parser('lipid', parents=[run, standardized], help='lipids/nuclei with a calibration profile')
+    command.add_argument('--profile', required=True, help='calibration profile (_profile.json or _points.csv)')
+    command.add_argument('--overlay', action='store_true', help='save full-size overlay images')
+    command.add_argument('--tiled', action='store_true',
+                         help='analyse .npy/raw array files tile by tile into a memory-mapped _labels.npy')
+    command.add_argument('--output', default=RESULTS_PATH, help='results database')
+    command.set_defaults(command=lipid_command)
+
+    command = commands.add_parser('stack', parents=[run, areas], help='multi-page TIFF stacks, frame by frame')
+    analysis = command.add_mutually_exclusive_group(required=True)
+    analysis.add_argument('--red', type=int, metavar='THRESHOLD', help='percent red with this red threshold (0-255)')
+    analysis.add_argument('--profile', help='lipids/nuclei with this calibration profile')
+    analysis.add_argument('--standardize', action='store_true', help='write standardized frames')
+    command.add_argument('--output', help='results database, or the folder for standardized frames')
+    command.set_defaults(command=stack_command)
+
+    command = commands.add_parser('screen', parents=[run], help='fast approximate screening against a cutoff')
+    analysis = command.add_mutually_exclusive_group(required=True)
+    analysis.add_argument('--red', type=int, metavar='THRESHOLD', help='percent red with this red threshold (0-255)')
+    analysis.add_argument('--profile', help='lipids/nuclei with this calibration profile')
+    command.add_argument('--cutoff', type=float, required=True, help='percentage the images are sorted by')
+    command.add_argument('--class', dest='cls', choices=['Lipids', 'Nuclei'], default='Lipids',
+                         help='class screened with --profile')
+    command.add_argument('--pixels', type=int, help='pixels sampled per image (default 250000)')
+    command.add_argument('--output', default=RESULTS_PATH, help='results database')
+    command.set_defaults(command=screen_command)
+
+    command = commands.add_parser('clear-cache', help='remove all cached results')
+    command.set_defaults(command=clear_cache_command)
+    return parser
+
+
 def get_path():
     return input('Please enter the image/directory path: ')
 
 
-def main():
-    results = None
+# number of worker processes for folders, blank for 1 and 0 for one per CPU core.
+def get_workers():
+    workers = input('Please enter the number of worker processes for folders (leave blank for 1, 0 for all cores): ')
+    return int(workers) if workers.strip() else 1
+
+
+def get_yes(question):
+    return input(f'{question} (y/n): ').lower().startswith('y')
 
+
+# the interactive menu, asking for the settings of a command and running it
+def menu():
     while True:
         func = input(
-            'Functions:\n-s = Standardize\n-p = Percent Red in Image\n-q = Quit\nPlease enter desired function: ')
+            'Functions:\n-s = Standardize\n-p = Percent Red in Image\n-t = Red Threshold Sweep (all thresholds)\n-l = Lipids/Nuclei with a Calibration Profile\n-sp = Standardize then Percent Red (in memory)\n-sl = Standardize then Lipids/Nuclei (in memory)\n-z = Multi-page TIFF Stacks, Frame by Frame\n-r = Screen Against a Cutoff (approximate, fast)\n-c = Clear Cached Results\n-q = Quit\nPlease enter desired function: ')
+        args = argparse.Namespace(path=None, workers=1, output=None, areas=None, union=False, standardize=False,
+                                  save_standardized=False, tiled=False)
 
         if func == '-s':
-            img = get_path()
-            run_script(img, standardize_image)
+            args.path = get_path()
+            args.format = input('Please enter the output format (leave blank for png): ').strip().lstrip('.') or 'png'
+            compression = input('Please enter the PNG compression level 0-9 (leave blank for the default): ').strip()
+            args.png_compression = int(compression) if compression else None
+            if Path(args.path).is_dir():
+                args.workers = get_workers()
+            standardize_command(args)
+
+        elif func in ('-p', '-sp'):
+            args.path = get_path()
+            args.threshold = int(input('Please enter the red threshold (0-255): '))
+            args.areas = input('Please enter a saved areas file/directory (leave blank to select areas): ') or None
+            args.union = get_yes('Count overlapping areas once?')
+            if func == '-sp':
+                args.standardize = True
+                args.save_standardized = get_yes('Also save the standardized images?')
+            args.workers, args.output = get_workers(), RESULTS_PATH
+            red_command(args)
+
+        elif func == '-t':
+            args.path = get_path()
+            args.areas = input('Please enter a saved areas file/directory (leave blank to select areas): ') or None
+            args.union = get_yes('Count overlapping areas once?')
+            output_path = input('Please enter the output table path (leave blank for threshold_sweep.csv): ')
+            args.output = output_path or 'threshold_sweep.csv'
+            args.workers = get_workers()
+            sweep_command(args)
+
+        elif func in ('-l', '-sl'):
+            args.path = get_path()
+            args.profile = input('Please enter the calibration profile (_profile.json or _points.csv): ')
+            args.overlay = get_yes('Save full-size overlay images?')
+            if func == '-sl':
+                args.standardize = True
+                args.save_standardized = get_yes('Also save the standardized images?')
+            args.workers, args.output = get_workers(), RESULTS_PATH
+            lipid_command(args)
 
-        elif func == '-p':
-            img = get_path()
-            red_threshold = int(input('Please enter the red threshold (0-255): '))
-            results = run_script(img, get_relative_red, red_threshold)
+        elif func == '-z':
+            args.path = get_path()
+            analysis = input('Analysis (p = percent red, l = lipids/nuclei, s = standardize): ').strip().lower()
+            args.red, args.profile = None, None
+            if analysis == 'p':
+                args.red = int(input('Please enter the red threshold (0-255): '))
+                args.areas = input('Please enter a saved areas file/directory (leave blank to select areas): ') or None
+                args.union = get_yes('Count overlapping areas once?')
+            elif analysis == 'l':
+                args.profile = input('Please enter the calibration profile (_profile.json or _points.csv): ')
+            args.workers = get_workers()
+            stack_command(args)
+
+        elif func == '-r':
+            args.path = get_path()
+            args.red, args.profile, args.cls, args.pixels = None, None, 'Lipids', None
+            if input('Analysis (p = percent red, l = lipids/nuclei): ').strip().lower() == 'l':
+                args.profile = input('Please enter the calibration profile (_profile.json or _points.csv): ')
+                if input('Class (l = lipids, n = nuclei): ').strip().lower() == 'n':
+                    args.cls = 'Nuclei'
+            else:
+                args.red = int(input('Please enter the red threshold (0-255): '))
+            args.cutoff = float(input('Please enter the cutoff percentage: '))
+            args.workers, args.output = get_workers(), RESULTS_PATH
+            screen_command(args)
+
+        elif func == '-c':
+            clear_cache_command(args)
 
         elif func == '-q':
             break
@@ -68,5 +467,18 @@ def main():
             print(f'Error: {func} is not a valid function.')
 
 
+"""
+Runs one command from the command line, e.g. python main.py red slides --threshold 30 --areas SelectedAreaImages,
+or the interactive menu when no arguments are given. python main.py <command> --help lists a command's options.
+"""
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        menu()
+        return
+    args = build_parser().parse_args(argv)
+    args.command(args)
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
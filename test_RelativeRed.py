@@ -0,0 +1,61 @@
+"""
+Parity of the vectorised redscale_array with the original per-pixel redscale loop.
+
+    python -m pytest test_RelativeRed.py
+
+The full grid runs the reference loop on every (r, g, b) combination, about a minute.
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import RelativeRed
+
+
+# the original redscale_image loop, kept as the reference: int() truncates toward zero and putpixel
+# clamps negative values to 0
+def redscale_reference(img):
+    img = img.convert('RGB')
+    redscaled_img = Image.new('RGB', img.size)
+    for x in range(img.width):
+        for y in range(img.height):
+            r, g, b = img.getpixel((x, y))
+            redscaled_color = (int(r - 0.5 * g - 0.5 * b), 0, 0)
+            redscaled_img.putpixel((x, y), redscaled_color)
+    return np.asarray(redscaled_img)[..., 0]
+
+
+def assert_parity(rgb):
+    np.testing.assert_array_equal(RelativeRed.redscale_array(rgb), redscale_reference(Image.fromarray(rgb)))
+
+
+# every (g, b) pair for one red value, as a 256 x 256 image
+def grid_for_red(red):
+    g, b = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+    return np.dstack([np.full_like(g, red), g, b])
+
+
+@pytest.mark.parametrize('red', range(256))
+def test_full_grid(red):
+    assert_parity(grid_for_red(red))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_images(seed):
+    rng = np.random.default_rng(seed)
+    assert_parity(rng.integers(0, 256, (97, 131, 3), dtype=np.uint8))
+
+
+def test_negative_and_odd_sums():
+    pixels = np.array([[
+        (0, 255, 255),    # most negative value, clamped to 0
+        (10, 11, 10),     # -0.5 truncates to 0
+        (10, 13, 10),     # -1.5 clamps to 0
+        (11, 10, 11),     # odd sum, 0.5 truncates to 0
+        (12, 10, 11),     # odd sum, 1.5 truncates to 1
+        (255, 0, 1),      # odd sum, 254.5 truncates to 254
+        (255, 0, 0),      # maximum
+    ]], dtype=np.uint8)
+    assert_parity(pixels)
+    assert RelativeRed.redscale_array(pixels).tolist() == [[0, 0, 0, 0, 1, 254, 255]]
@@ -0,0 +1,101 @@
+"""
+Parity of the lookup-table classify_channels with the original per-pixel ratio expressions, and of the
+tiled lipid/nuclei masks with a whole-image run, at the tile seams as everywhere else.
+
+    python -m pytest test_UpdatedCodeLipidNuclei.py
+
+The full grid classifies every (r, g, b) combination.
+"""
+
+import json
+from functools import partial
+
+import numpy as np
+import pytest
+
+import ResultCache
+import UpdatedCodeLipidNuclei as lipid
+
+
+# the original classify_channels, kept as the reference: float64 channel ratios compared per pixel
+def classify_reference(image, lipid_thresh=lipid.LIPID_THRESH, nuclei_thresh=lipid.NUCLEI_THRESH,
+                       nuclei_min_blue=lipid.NUCLEI_MIN_BLUE):
+    h, w = image.shape[:2]
+    lipid_mask = np.zeros((h, w), dtype=np.uint8)
+    nuclei_mask = np.zeros((h, w), dtype=np.uint8)
+
+    R = image[:, :, 2].astype(float)
+    B = image[:, :, 0].astype(float)
+    red_ratio = R / (B + 1e-5)
+    blue_ratio = B / (R + 1e-5)
+
+    lipid_mask[(red_ratio > lipid_thresh) & (red_ratio > blue_ratio)] = 255
+    nuclei_mask[(blue_ratio > nuclei_thresh) & (blue_ratio > red_ratio) & (B > nuclei_min_blue)] = 255
+    return lipid_mask, nuclei_mask
+
+
+def assert_parity(image, *settings):
+    for mask, reference in zip(lipid.classify_channels(image, *settings), classify_reference(image, *settings)):
+        np.testing.assert_array_equal(mask, reference)
+
+
+# every (r, b) pair for one green value, as a 256 x 256 BGR image
+def grid_for_green(green):
+    r, b = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+    return np.dstack([b, np.full_like(r, green), r])
+
+
+@pytest.mark.parametrize('green', range(256))
+def test_full_grid(green):
+    assert_parity(grid_for_green(green))
+
+
+# thresholds a calibration profile may set, including ratios hit exactly by integer pairs (2 = 200 / 100)
+@pytest.mark.parametrize('settings', [(1.0, 1.0, 0), (2.0, 2.0, 100), (1.25, 3.5, 254), (0.5, 0.8, 255)])
+def test_profile_thresholds(settings):
+    assert_parity(grid_for_green(0), *settings)
+
+
+def test_chunked_rows(monkeypatch):
+    monkeypatch.setattr(lipid, 'CLASSIFY_CHUNK_PIXELS', 1000)
+    image = np.random.default_rng(0).integers(0, 256, (97, 131, 3), dtype=np.uint8)
+    assert_parity(image)
+
+
+# a BGR image of noise (specks for the nuclei cleanup) with red and blue blobs, many of them across tile seams
+def blob_image(h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[:h, :w]
+    for _ in range(40):
+        y, x, r = rng.integers(0, h), rng.integers(0, w), rng.integers(3, 15)
+        blob = (yy - y) ** 2 + (xx - x) ** 2 <= r * r
+        image[blob] = (220, 40, 30) if rng.random() < 0.5 else (30, 40, 220)
+    return image
+
+
+@pytest.mark.parametrize('tile_size', [16, 50, 64])
+@pytest.mark.parametrize('shape', [(256, 256), (203, 317)])
+def test_tiled_matches_whole_image(tmp_path, tile_size, shape):
+    image = blob_image(*shape)
+    labels_path = tmp_path / 'labels.npy'
+    counts = lipid.build_masks_tiled(image, str(labels_path), tile_size=tile_size, workers=2)
+
+    labels = lipid.label_map(lipid.build_masks(image))
+    np.testing.assert_array_equal(np.load(labels_path), labels)
+    assert counts == lipid.label_counts(labels)
+
+
+def test_headless_tiled_matches_whole_image(tmp_path, monkeypatch):
+    monkeypatch.setattr(ResultCache, 'CACHE_PATH', 'off')
+    monkeypatch.setattr(lipid, 'build_masks_tiled', partial(lipid.build_masks_tiled, tile_size=64))
+    profile_path = tmp_path / 'profile.json'
+    profile_path.write_text(json.dumps({}))
+    image_path = tmp_path / 'slide.npy'
+    np.save(image_path, blob_image(200, 300)[..., ::-1])  # array files are RGB
+
+    whole = lipid.analyze_with_profile(str(image_path), str(profile_path))
+    tiled = lipid.analyze_with_profile(str(image_path), str(profile_path), tiled=True)
+    assert tiled['rows'] == whole['rows']
+    np.testing.assert_array_equal(np.load(tmp_path / 'slide_labels.npy'),
+                                  lipid.load_labels(str(tmp_path / 'slide_labels.npz')))